@@ -0,0 +1,121 @@
+"""
+Micro-benchmark of the color matching: compares the batched NumPy engine of
+`laudare.utils` with the previous implementation, which parsed the strings and called
+`np.linalg.norm` once per candidate color.
+
+Usage: python benchmarks/bench_colors.py [--nodes N] [--colors K] [--rules R]
+"""
+
+import argparse
+import random
+import sys
+import timeit
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from laudare import utils  # noqa: E402
+
+
+def legacy_match_colors(color_query, *colors, euclidean_th=150):
+    """The implementation of `utils.match_colors` before the NumPy engine"""
+    color_rgb = np.array([int(c) for c in color_query[4:-1].split(",")])
+    for color in colors:
+        if color is not None:
+            c_rgb = np.array([int(c) for c in color[4:-1].split(",")])
+            distance = np.linalg.norm(color_rgb - c_rgb)
+            if distance < euclidean_th:
+                return True
+    return False
+
+
+def legacy_palette(node_colors):
+    """The loop of `utils.get_svg_palette` before the NumPy engine, over a list of
+    `(fill, stroke)` pairs"""
+    colors = set()
+    for fill, stroke in node_colors:
+        if stroke is not None and not legacy_match_colors(stroke, *colors):
+            colors.add(stroke)
+        if fill is not None and not legacy_match_colors(fill, *colors):
+            colors.add(fill)
+    return colors
+
+
+def batched_filter(node_colors, rule_colors):
+    """Rule filter on top of the batched API: one broadcasted operation per rule
+    set"""
+    fills, fills_valid = utils.rgb_array(f for f, _ in node_colors)
+    strokes, strokes_valid = utils.rgb_array(s for _, s in node_colors)
+    rules, _ = utils.rgb_array(rule_colors)
+    return utils.matching_colors(rules, fills, fills_valid) | utils.matching_colors(
+        rules, strokes, strokes_valid
+    )
+
+
+def legacy_filter(node_colors, rule_colors):
+    return np.array(
+        [
+            [legacy_match_colors(rule, fill, stroke) for fill, stroke in node_colors]
+            for rule in rule_colors
+        ]
+    )
+
+
+def batched_palette(node_colors):
+    """The loop of `utils.get_svg_palette`, over a list of `(fill, stroke)` pairs"""
+    colors = []
+    for fill, stroke in node_colors:
+        if stroke is not None:
+            colors.append(stroke)
+        if fill is not None:
+            colors.append(fill)
+    return utils.reduce_palette(colors)
+
+
+def random_color(rng):
+    return f"rgb({rng.randint(0, 255)},{rng.randint(0, 255)},{rng.randint(0, 255)})"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--nodes", type=int, default=20000)
+    parser.add_argument("--colors", type=int, default=12)
+    parser.add_argument("--rules", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    palette = [random_color(rng) for _ in range(args.colors)] + [None]
+    node_colors = [(rng.choice(palette), rng.choice(palette)) for _ in range(args.nodes)]
+    rule_colors = [random_color(rng) for _ in range(args.rules)]
+
+    assert (
+        batched_filter(node_colors, rule_colors)
+        == legacy_filter(node_colors, rule_colors)
+    ).all()
+    assert batched_palette(node_colors) == legacy_palette(node_colors)
+
+    def best(func):
+        return min(timeit.repeat(func, number=1, repeat=args.repeat))
+
+    print(f"{args.nodes} nodes, {args.colors} colors, {args.rules} rules")
+    rows = [
+        (
+            "rule filter",
+            best(lambda: legacy_filter(node_colors, rule_colors)),
+            best(lambda: batched_filter(node_colors, rule_colors)),
+        ),
+        (
+            "palette",
+            best(lambda: legacy_palette(node_colors)),
+            best(lambda: batched_palette(node_colors)),
+        ),
+    ]
+    print(f"{'':12s} {'legacy':>10s} {'numpy':>10s} {'speed-up':>9s}")
+    for name, legacy, batched in rows:
+        print(f"{name:12s} {legacy:9.4f}s {batched:9.4f}s {legacy / batched:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
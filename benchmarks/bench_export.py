@@ -0,0 +1,265 @@
+"""
+Times each stage of the export and of the count on synthetic pages (see
+`synthetic.py`) of increasing size, so that the effect of a change on each stage and
+on the scaling can be measured against a baseline saved before the change.
+
+The stages are those of `LaudareExport.write_annotations`:
+
+- parse: loading the SVG file with inkex;
+- analysis: `analysis.DocumentAnalysis`, the styles, colors and visibility of all the
+  nodes (the transforms are resolved on demand by the bounding boxes);
+- info: `LaudareExport.fill_info`, the size of the page and the encoded image;
+- text bboxes: `export.get_text_element_bounding_box`, without the disk cache;
+- color filter: building the `matching.ColorIndex` and assigning the nodes to the
+  rules with `matching.CompiledRules`;
+- elements: the annotations of the elements, mostly their bounding boxes;
+- groups: the annotations of the groups, reusing the boxes of the elements;
+- close: closing the writer of the annotations;
+- serialization: writing the annotations as JSON with `jsonstream.AnnotationWriter`;
+- count: `LaudareCount.count_annotations` on the result.
+
+"total" is a complete `write_annotations` on a newly parsed document.
+
+Usage:
+    python benchmarks/bench_export.py --sizes 500 1000 2000 --save before.json
+    (change the code)
+    python benchmarks/bench_export.py --compare before.json
+"""
+
+import argparse
+import io
+import json
+import platform
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import inkex
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import synthetic  # noqa: E402
+from laudare import count, export, utils  # noqa: E402
+from laudare.analysis import DocumentAnalysis  # noqa: E402
+from laudare.jsonstream import (  # noqa: E402
+    AnnotationWriter,
+    DictWriter,
+    write_dict,
+)
+from laudare.matching import ColorIndex, CompiledRules  # noqa: E402
+
+STAGES = (
+    "parse",
+    "analysis",
+    "info",
+    "text bboxes",
+    "color filter",
+    "elements",
+    "groups",
+    "close",
+    "serialization",
+    "count",
+    "total",
+)
+
+
+class Timer:
+    """Accumulates the time spent in each stage"""
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self._start = time.perf_counter()
+
+    def lap(self, stage):
+        """Charges the time since the previous lap to `stage`"""
+        now = time.perf_counter()
+        self.seconds[stage] += now - self._start
+        self._start = now
+
+
+def run_stages(svg_path, rules, text_bbox_mode):
+    """Runs the export of `svg_path` one stage at a time, in the same way as
+    `LaudareExport.write_annotations`, and returns the seconds of each stage"""
+    timer = Timer()
+    extension = export.LaudareExport()
+    extension.text_bbox_mode = text_bbox_mode
+    extension.svg = inkex.load_svg(str(svg_path)).getroot()
+    timer.lap("parse")
+
+    extension.analysis = DocumentAnalysis(extension.svg)
+    all_groups = extension.analysis.nodes_of_type(inkex.Group)
+    timer.lap("analysis")
+
+    json_data = {}
+    extension.fill_info(json_data)
+    timer.lap("info")
+
+    extension.text_bboxes = export.get_text_element_bounding_box(
+        extension.svg, use_cache=False, mode=text_bbox_mode
+    )
+    timer.lap("text bboxes")
+
+    writer = DictWriter()
+    writer.write_info(json_data["info"])
+    color_index = ColorIndex(
+        extension.analysis.records,
+        {rule[0]: extension.object_types[rule[0]] for rule in rules.values()},
+    )
+    assigned = color_index.assign(CompiledRules(rules))
+    timer.lap("color filter")
+    for label, (obj, color, isgroup, _, _) in rules.items():
+        obj_elements_color = assigned[label]
+        writer.begin_label(label, color, obj)
+        if not isgroup:
+            for id, annotation in extension.element_annotations(obj_elements_color):
+                writer.add(id, annotation)
+        writer.begin_groups()
+        if isgroup:
+            for id, annotation in extension.group_annotations(
+                all_groups, obj_elements_color
+            ):
+                writer.add(id, annotation)
+        writer.end_label()
+        timer.lap("groups" if isgroup else "elements")
+    writer.close()
+    timer.lap("close")
+
+    write_dict(writer.data, AnnotationWriter(io.StringIO()))
+    timer.lap("serialization")
+
+    count.LaudareCount().count_annotations(writer.data)
+    timer.lap("count")
+
+    extension = export.LaudareExport()
+    extension.text_bbox_mode = text_bbox_mode
+    extension.svg = inkex.load_svg(str(svg_path)).getroot()
+    extension.write_annotations(rules, AnnotationWriter(io.StringIO()))
+    timer.lap("total")
+    return timer.seconds
+
+
+def run(args):
+    """Returns `{size: {stage: seconds}}`, the best of `args.repeat` runs for each
+    stage"""
+    rules = utils.check_rule_dict(synthetic.make_rules(args.colors))
+    results = {}
+    with TemporaryDirectory() as tmpdir:
+        for size in args.sizes:
+            svg_path = Path(tmpdir) / f"page{size}.svg"
+            svg_path.write_text(
+                synthetic.make_page(
+                    size, args.colors, max(1, size // args.marks_per_group), args.depth
+                )
+            )
+            runs = [
+                run_stages(svg_path, rules, args.text_bbox)
+                for _ in range(args.repeat)
+            ]
+            results[str(size)] = {
+                stage: min(r[stage] for r in runs) for stage in STAGES
+            }
+            print_row(size, results[str(size)])
+    return results
+
+
+def print_header():
+    print(f"{'marks':>7s} " + " ".join(f"{s:>13s}" for s in STAGES))
+
+
+def print_row(size, seconds, baseline=None):
+    cells = []
+    for stage in STAGES:
+        if baseline is None:
+            cells.append(f"{seconds[stage]:12.4f}s")
+        else:
+            ratio = seconds[stage] / max(baseline[stage], 1e-9)
+            cells.append(f"{ratio:12.2f}x")
+    print(f"{size:>7} " + " ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[250, 500, 1000, 2000, 4000]
+    )
+    parser.add_argument("--colors", type=int, default=4)
+    parser.add_argument(
+        "--marks-per-group",
+        type=int,
+        default=10,
+        help="The number of groups is the number of marks divided by this",
+    )
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument(
+        "--text-bbox",
+        choices=export.TEXT_BBOX_MODES,
+        default="native",
+        help="How the boxes of the texts are computed; inkscape and shell need "
+        "Inkscape in the PATH",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", help="Save the results as a JSON baseline")
+    parser.add_argument(
+        "--compare",
+        help="Compare with a baseline saved by --save, with the same sizes",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.25,
+        help="With --compare, fail if a stage is slower than the baseline by more "
+        "than this ratio",
+    )
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        args.sizes = [int(size) for size in baseline["results"]]
+        for name in ("colors", "marks_per_group", "depth", "text_bbox"):
+            setattr(args, name, baseline["args"][name])
+
+    print_header()
+    results = run(args)
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "args": {
+                        "colors": args.colors,
+                        "marks_per_group": args.marks_per_group,
+                        "depth": args.depth,
+                        "text_bbox": args.text_bbox,
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+    if baseline is None:
+        return 0
+    print("\nratio to the baseline")
+    print_header()
+    slower = []
+    for size, seconds in results.items():
+        print_row(size, seconds, baseline["results"][size])
+        slower += [
+            (size, stage)
+            for stage in STAGES
+            if seconds[stage] > args.tolerance * baseline["results"][size][stage]
+            # ignore the noise of the stages that take less than a millisecond
+            and seconds[stage] > 1e-3
+        ]
+    for size, stage in slower:
+        print(f"{stage} is slower than the baseline with {size} marks")
+    return 1 if len(slower) > 0 else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
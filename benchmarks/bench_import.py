@@ -0,0 +1,106 @@
+"""
+Measures the time needed to import the modules of the extensions with
+`python -X importtime`, in a fresh interpreter for each module, and checks that the
+modules that are only needed by some code paths (GTK, NumPy for the tools that only
+read JSON files) are not imported, and that importing has no side effects (the log
+file is not configured).
+
+The time of the modules of `laudare` and of the modules that they import is reported
+separately from the time of inkex, which Inkscape pays anyway. With `--max-ms`, the
+script exits with status 1 if the import of a module takes longer than that, so that
+it can guard against regressions.
+
+Usage: python benchmarks/bench_import.py [--repeat N] [--max-ms MS]
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# module -> top-level packages that it must not import
+MODULES = {
+    "laudare.export": ["gi"],
+    "laudare.count": ["gi"],
+    "laudare.batch_export": ["gi"],
+    "laudare.batch_count": ["gi", "inkex", "numpy"],
+}
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| *(\S+)")
+
+# printed by the child interpreter after the import
+CHECK = (
+    "import json, logging, sys; "
+    "print(json.dumps(sorted({m.split('.')[0] for m in sys.modules}))); "
+    "print(len(logging.getLogger().handlers))"
+)
+
+
+def import_time(module):
+    """
+    Imports `module` in a new interpreter.
+
+    Returns:
+        tuple: The cumulative import times in microseconds of all the modules
+            imported as a dict, the set of the top-level packages imported and the
+            number of handlers of the root logger after the import.
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}; {CHECK}"],
+        cwd=ROOT,
+        env={**os.environ, "PYTHONPATH": str(ROOT)},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for match in LINE.finditer(process.stderr):
+        _, cumulative, name = match.groups()
+        times[name] = int(cumulative)
+    packages, handlers = process.stdout.splitlines()[-2:]
+    return times, set(json.loads(packages)), int(handlers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=None,
+        help="Fail if the import of a module, inkex excluded, takes longer",
+    )
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':24s} {'total':>9s} {'inkex':>9s} {'own':>9s}")
+    for module, forbidden in MODULES.items():
+        runs = [import_time(module) for _ in range(args.repeat)]
+        totals = [times[module] for times, _, _ in runs]
+        best = min(range(len(runs)), key=lambda i: totals[i])
+        times, packages, handlers = runs[best]
+        total = times[module] / 1000
+        inkex = times.get("inkex", 0) / 1000
+        own = total - inkex
+        print(f"{module:24s} {total:7.1f}ms {inkex:7.1f}ms {own:7.1f}ms")
+
+        for package in forbidden:
+            if package in packages:
+                print(f"  {module} imports {package}")
+                failed = True
+        if handlers > 0:
+            print(f"  {module} configures logging when imported")
+            failed = True
+        if args.max_ms is not None and own > args.max_ms:
+            print(f"  {module} takes more than {args.max_ms}ms")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,80 @@
+"""
+Reports the deviation of the bounding boxes of texts estimated from the font metrics
+(`--text-bbox native`) from those computed by Inkscape, over a corpus of SVG files.
+Inkscape must be in the PATH.
+
+Usage: python benchmarks/compare_text_bbox.py page1.svg page2.svg "folios/*.svg"
+"""
+
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import inkex
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from laudare import batch_export, export  # noqa: E402
+
+
+def iou(a, b):
+    """Intersection over union of two `BoundingBox`"""
+    width = min(a.right, b.right) - max(a.left, b.left)
+    height = min(a.bottom, b.bottom) - max(a.top, b.top)
+    intersection = max(width, 0) * max(height, 0)
+    union = a.width * a.height + b.width * b.height - intersection
+    return intersection / union if union > 0 else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("svgs", nargs="+")
+    args = parser.parse_args()
+
+    deviations = {"x": [], "y": [], "w": [], "h": []}
+    ious = []
+    times = {"inkscape": 0.0, "native": 0.0}
+    missing = 0
+    for path in batch_export.expand_paths(args.svgs):
+        svg = inkex.load_svg(str(path)).getroot()
+        start = time.perf_counter()
+        reference = export.get_text_element_bounding_box(svg, use_cache=False)
+        times["inkscape"] += time.perf_counter() - start
+        start = time.perf_counter()
+        estimated = export.get_text_element_bounding_box(svg, mode="native")
+        times["native"] += time.perf_counter() - start
+
+        for node in svg.descendants().filter(inkex.TextElement):
+            ref = reference.get(node.get_id())
+            est = estimated.get(node.get_id())
+            if ref is None or est is None:
+                missing += ref is not None
+                continue
+            deviations["x"].append(abs(est.left - ref.left))
+            deviations["y"].append(abs(est.top - ref.top))
+            deviations["w"].append(abs(est.width - ref.width))
+            deviations["h"].append(abs(est.height - ref.height))
+            ious.append(iou(est, ref))
+
+    if len(ious) == 0:
+        print("No text element found")
+        return
+    print(f"{len(ious)} text elements, {missing} not estimated")
+    print(f"{'':4s} {'mean':>9s} {'median':>9s} {'max':>9s}   (absolute deviation, px)")
+    for name, values in deviations.items():
+        print(
+            f"{name:4s} {statistics.mean(values):9.3f} "
+            f"{statistics.median(values):9.3f} {max(values):9.3f}"
+        )
+    print(
+        f"IoU  mean {statistics.mean(ious):.3f}, median {statistics.median(ious):.3f},"
+        f" min {min(ious):.3f}"
+    )
+    print(
+        f"time inkscape {times['inkscape']:.2f}s, native {times['native']:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Generates synthetic SVG pages that look like the annotated manuscript pages: one
+embedded image and many marks (texts, rectangles, ellipses and paths) in a few
+colors, nested into groups of varying depth with transforms.
+
+Usage: python benchmarks/synthetic.py out.svg [--marks N] [--colors K] [--groups G]
+"""
+
+import argparse
+import random
+
+# a 1x1 PNG
+IMAGE = (
+    "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42m"
+    "NkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+HEADER = (
+    '<svg xmlns="http://www.w3.org/2000/svg" '
+    'xmlns:xlink="http://www.w3.org/1999/xlink" '
+    'xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" '
+    'width="{size}" height="{size}" viewBox="0 0 {size} {size}">'
+)
+
+WORDS = ("Laude", "novella", "sia", "cantata", "a", "l'alta", "donna", "encoronata")
+
+
+def palette(n_colors, seed=0):
+    """Returns `n_colors` colors in #rrggbb format, far enough from each other to be
+    matched by different rules when `n_colors` is small"""
+    rng = random.Random(seed)
+    colors = []
+    for i in range(n_colors):
+        hue = [0, 0, 0]
+        hue[i % 3] = 255 - 64 * (i // 3 % 4)
+        hue[(i + 1) % 3] = rng.randint(0, 48)
+        colors.append("#{:02x}{:02x}{:02x}".format(*hue))
+    return colors
+
+
+def _transform(rng):
+    kind = rng.randrange(4)
+    if kind == 0:
+        return f"translate({rng.uniform(-20, 20):.2f},{rng.uniform(-20, 20):.2f})"
+    elif kind == 1:
+        return f"scale({rng.uniform(0.8, 1.2):.3f})"
+    elif kind == 2:
+        return f"rotate({rng.uniform(-5, 5):.2f})"
+    return None
+
+
+def _mark(i, rng, color, size):
+    x, y = rng.uniform(0, size * 0.9), rng.uniform(0, size * 0.9)
+    kind = i % 4
+    stroke = f"fill:none;stroke:{color};stroke-width:1;stroke-opacity:1"
+    fill = f"fill:{color};fill-opacity:1;stroke:none"
+    if kind == 0:
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+        return (
+            f'<text id="text{i}" x="{x:.2f}" y="{y:.2f}" '
+            f'style="font-size:12px;font-family:serif;{fill}">'
+            f'<tspan id="tspan{i}" x="{x:.2f}" y="{y:.2f}">{words}</tspan></text>'
+        )
+    elif kind == 1:
+        return (
+            f'<rect id="rect{i}" x="{x:.2f}" y="{y:.2f}" '
+            f'width="{rng.uniform(5, 40):.2f}" height="{rng.uniform(5, 20):.2f}" '
+            f'style="{stroke}"/>'
+        )
+    elif kind == 2:
+        transform = _transform(rng)
+        transform = "" if transform is None else f' transform="{transform}"'
+        return (
+            f'<ellipse id="ellipse{i}" cx="{x:.2f}" cy="{y:.2f}" '
+            f'rx="{rng.uniform(2, 8):.2f}" ry="{rng.uniform(2, 8):.2f}"{transform} '
+            f'style="{fill}"/>'
+        )
+    points = " ".join(
+        f"{rng.uniform(-10, 10):.2f},{rng.uniform(-10, 10):.2f}" for _ in range(4)
+    )
+    return (
+        f'<path id="path{i}" d="M {x:.2f},{y:.2f} c {points} l 5,-3" '
+        f'style="{stroke}"/>'
+    )
+
+
+def make_page(n_marks=1000, n_colors=4, n_groups=100, max_depth=4, seed=0):
+    """
+    Generates a synthetic page.
+
+    Args:
+        n_marks (int): The number of texts, rectangles, ellipses and paths, in equal
+            numbers.
+        n_colors (int): The number of colors of the marks, see `palette`.
+        n_groups (int): The number of groups. Each group is put in the layer or in a
+            random group that is less than `max_depth` levels deep, and each mark in
+            the layer or in a random group.
+        seed (int): The seed of the random generator.
+
+    Returns:
+        str: The SVG document.
+    """
+    rng = random.Random(seed)
+    colors = palette(n_colors, seed)
+    size = max(1000, int(30 * n_marks**0.5))
+
+    # the children of each group, the layer being group -1
+    children = {-1: []}
+    depth = {-1: 0}
+    for g in range(n_groups):
+        parents = [p for p in children if depth[p] < max_depth]
+        parent = rng.choice(parents)
+        children[parent].append(("group", g))
+        children[g] = []
+        depth[g] = depth[parent] + 1
+    for i in range(n_marks):
+        children[rng.choice(list(children))].append(("mark", i))
+
+    out = [HEADER.format(size=size)]
+    out.append(
+        f'<image id="image" x="0" y="0" width="{size}" height="{size}" '
+        f'xlink:href="{IMAGE}"/>'
+    )
+
+    def write(group):
+        for kind, i in children[group]:
+            if kind == "mark":
+                out.append(_mark(i, rng, rng.choice(colors), size))
+            else:
+                transform = _transform(rng)
+                transform = "" if transform is None else f' transform="{transform}"'
+                out.append(f'<g id="g{i}"{transform}>')
+                write(i)
+                out.append("</g>")
+
+    out.append('<g id="layer1" inkscape:groupmode="layer" inkscape:label="Layer 1">')
+    write(-1)
+    out.append("</g></svg>")
+    return "\n".join(out)
+
+
+def make_rules(n_colors=4, seed=0):
+    """Returns rules in the format of `utils.check_rule_dict` for the pages of
+    `make_page`: one rule per shape and color, and one group rule per color"""
+    rules = {}
+    for color in palette(n_colors, seed):
+        for shape in ("Text", "Rectangle", "Ellipse", "Path"):
+            rules[f"{shape.lower()} {color}"] = [shape, color, False]
+        rules[f"group {color}"] = ["Path", color, True]
+    return rules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("output")
+    parser.add_argument("--marks", type=int, default=1000)
+    parser.add_argument("--colors", type=int, default=4)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    with open(args.output, "w") as f:
+        f.write(
+            make_page(args.marks, args.colors, args.groups, args.depth, args.seed)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+A module for analysing a document in a single pass over its tree, so that the palette
+shown in the GUI and the matching of the rules share the same parsed styles.
+"""
+
+from . import utils
+from .bbox import BoundingBoxes
+
+
+class NodeRecord:
+    """
+    What the export needs to know about a node: its tag, id, resolved colors (see
+    `utils.get_node_colors`) and visibility (see `utils.node_can_be_seen`), and its
+    bounding box (see `bbox`). Visibility and bounding box are computed on first
+    access and then kept.
+    """
+
+    __slots__ = ("node", "tag", "id", "fill", "stroke", "_visible", "_bboxes")
+
+    def __init__(self, node, bboxes):
+        self.node = node
+        self.tag = node.tag_name
+        self.id = node.get("id")
+        self.fill, self.stroke = utils.get_node_colors(node, bboxes)
+        self._visible = None
+        self._bboxes = bboxes
+
+    @property
+    def visible(self):
+        if self._visible is None:
+            self._visible = utils.node_can_be_seen(self.node, self._bboxes)
+        return self._visible
+
+    @property
+    def bbox(self):
+        """The bounding box of the node in the coordinates of the document, see
+        `bbox.BoundingBoxes`"""
+        return self._bboxes.bbox(self.node)
+
+
+class DocumentAnalysis:
+    """
+    The `NodeRecord` of all the nodes of a document, in document order, computed by
+    walking the tree once. The bounding boxes of all the records are computed by a
+    shared `bbox.BoundingBoxes`, `self.bboxes`.
+
+    Args:
+        svg (inkex.SvgDocumentElement): The document.
+    """
+
+    def __init__(self, svg):
+        self.bboxes = BoundingBoxes()
+        self.records = [NodeRecord(node, self.bboxes) for node in svg.descendants()]
+
+    def nodes_of_type(self, cls):
+        """Returns the nodes that are instances of `cls`, in document order"""
+        return [r.node for r in self.records if isinstance(r.node, cls)]
+
+    def palette(self, euclidean_th=150):
+        """Returns all the colors of the document as a set of rgb(..) strings, see
+        `utils.get_svg_palette`"""
+        colors = []
+        for record in self.records:
+            if record.stroke is not None:
+                colors.append(record.stroke)
+            if record.fill is not None:
+                colors.append(record.fill)
+        return utils.reduce_palette(colors, euclidean_th)
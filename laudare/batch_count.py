@@ -0,0 +1,115 @@
+"""
+A module for counting the annotations of many JSON files from the command line.
+
+It does not import GTK (nor Inkscape), so that it can run on servers with no display.
+"""
+
+import argparse
+import csv
+import json
+import sys
+import time
+
+from . import counting
+from .paths import expand_paths
+
+FORMATS = ("csv", "json")
+
+
+def counts_to_dict(counts):
+    """Converts counts with `(kind, key)` keys to a nested dict `{kind: {key: count}}`,
+    with keys sorted"""
+    kinds = (counting.KIND_LABEL, counting.KIND_GROUP, counting.KIND_TEXT)
+    nested = {kind: {} for kind in kinds}
+    for kind, key in sorted(counts):
+        nested[kind][key] = counts[(kind, key)]
+    return nested
+
+
+def write_json(stream, total, per_file=None):
+    """Writes the counts as `{"total": ..., "files": {path: ...}}`, see
+    `counts_to_dict`"""
+    data = {"total": counts_to_dict(total)}
+    if per_file is not None:
+        data["files"] = {
+            str(path): counts_to_dict(counts) for path, counts in per_file.items()
+        }
+    json.dump(data, stream, indent=2, ensure_ascii=False)
+    stream.write("\n")
+
+
+def write_csv(stream, total, per_file=None):
+    """Writes the counts as CSV rows `file, kind, key, count`; the rows of the total
+    have an empty `file`"""
+    writer = csv.writer(stream)
+    writer.writerow(["file", "kind", "key", "count"])
+    if per_file is not None:
+        for path, counts in per_file.items():
+            for kind, key in sorted(counts):
+                writer.writerow([str(path), kind, key, counts[(kind, key)]])
+    for kind, key in sorted(total):
+        writer.writerow(["", kind, key, total[(kind, key)]])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Count the annotations of many Laudare JSON files"
+    )
+    parser.add_argument(
+        "jsons", nargs="+", help="JSON files, directories or glob patterns"
+    )
+    parser.add_argument(
+        "-f", "--format", choices=FORMATS, default="csv", help="Output format"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="Output file (default: standard output)",
+    )
+    parser.add_argument(
+        "--total-only",
+        action="store_true",
+        help="Only write the counts summed over all the files",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Count every file again, instead of reusing the counts of the files that "
+        "did not change since the previous run",
+    )
+    args = parser.parse_args(argv)
+
+    paths = expand_paths(args.jsons, suffix=".json")
+    # the sidecar files of incremental exports are not annotations
+    paths = [p for p in paths if not p.name.endswith(".fingerprints.json")]
+    if len(paths) == 0:
+        parser.error("No JSON file found")
+
+    start = time.perf_counter()
+    total, per_file, failed = counting.count_files(
+        paths, workers=args.workers, use_cache=not args.no_cache
+    )
+    if args.total_only:
+        per_file = None
+    write = write_json if args.format == "json" else write_csv
+    if args.output is None:
+        write(sys.stdout, total, per_file)
+    else:
+        with open(args.output, "w", newline="", encoding="utf-8") as f:
+            write(f, total, per_file)
+    print(
+        f"Counted {len(paths) - len(failed)}/{len(paths)} files "
+        f"in {time.perf_counter() - start:.2f}s",
+        file=sys.stderr,
+    )
+    for path, error in failed.items():
+        print(f"Failed: {path}: {error}", file=sys.stderr)
+    return 1 if failed else 0
@@ -0,0 +1,281 @@
+"""A module for exporting many annotated SVG files without the GUI."""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+import inkex
+
+from . import columnar, profiling, utils
+from .export import TEXT_BBOX_MODES, LaudareExport
+from .incremental import IncrementalExport
+from .jsonstream import AnnotationWriter
+from .paths import expand_paths
+
+OUTPUT_FORMATS = ("json", "columnar")
+
+
+def load_rules(path):
+    """Load the rules from a JSON file written by `MainGui.save_config`"""
+    with open(path, "r") as f:
+        rules = json.load(f)
+    return utils.check_rule_dict(rules)
+
+
+def output_path(svg_path, output_dir=None, suffix=".json"):
+    """Returns the path of the output file for `svg_path`: same stem, in `output_dir`
+    if provided, otherwise next to the SVG file"""
+    svg_path = Path(svg_path)
+    output_dir = svg_path.parent if output_dir is None else Path(output_dir)
+    return output_dir / (svg_path.stem + suffix)
+
+
+def export_file(
+    svg_path,
+    rules,
+    output_dir=None,
+    text_bbox_mode="inkscape",
+    image_dir=None,
+    incremental=False,
+    output_format="json",
+    profile="off",
+):
+    """
+    Exports the annotations of a single SVG file into a JSON file.
+
+    Args:
+        svg_path (str or Path): The annotated SVG file.
+        rules (dict): The rules, as returned by `load_rules`.
+        output_dir (str or Path): Where the JSON file is written. Defaults to the
+            directory of the SVG file.
+        text_bbox_mode (str): How the bounding boxes of texts are computed, one of
+            `export.TEXT_BBOX_MODES`.
+        image_dir (str or Path): If set, an embedded image is written in this
+            directory (relative to the directory of the JSON file) instead of inside
+            the JSON file, see `images.externalize_image`.
+        incremental (bool): If True, only the nodes that changed since the previous
+            export of the same file are recomputed, see `incremental`.
+        output_format (str): One of `OUTPUT_FORMATS`: "json", or "columnar" for a
+            `.columns` directory, see `columnar`. The columnar format cannot be
+            exported incrementally.
+        profile (str): One of `profiling.PROFILE_MODES`, see
+            `LaudareExport.write_annotations`.
+
+    Returns:
+        Path: The path of the JSON file (or columnar directory) written.
+    """
+    if output_format == "columnar":
+        if incremental:
+            raise ValueError("The columnar format cannot be exported incrementally")
+        out = output_path(svg_path, output_dir, suffix=columnar.SUFFIX)
+    else:
+        out = output_path(svg_path, output_dir)
+    extension = LaudareExport()
+    extension.text_bbox_mode = text_bbox_mode
+    extension.profile = profile
+    if image_dir is not None:
+        extension.image_dir = out.parent / image_dir
+        extension.output_dir = out.parent
+    if incremental:
+        extension.incremental = IncrementalExport.load(out)
+    extension.svg = inkex.load_svg(str(svg_path)).getroot()
+    if output_format == "columnar":
+        extension.write_annotations(rules, columnar.ColumnarWriter(out))
+    else:
+        # write to a temporary file first, so that a failed export does not destroy
+        # the JSON file of a previous export
+        fd, tmp_path = tempfile.mkstemp(dir=out.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                extension.write_annotations(rules, AnnotationWriter(f))
+            os.replace(tmp_path, out)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    if incremental:
+        extension.incremental.save(out)
+    return out
+
+
+def _export_worker(svg_path, rules, output_dir, *args):
+    """Runs `export_file` in a worker process, never raising: returns a tuple
+    `(svg_path, json_path, seconds, error)`"""
+    start = time.perf_counter()
+    try:
+        out = export_file(svg_path, rules, output_dir, *args)
+        return svg_path, out, time.perf_counter() - start, None
+    except Exception:
+        return svg_path, None, time.perf_counter() - start, traceback.format_exc()
+
+
+def batch_export(
+    svg_paths,
+    rules,
+    output_dir=None,
+    workers=None,
+    report=None,
+    text_bbox_mode="inkscape",
+    image_dir=None,
+    incremental=False,
+    output_format="json",
+    profile="off",
+):
+    """
+    Exports the annotations of many SVG files using a pool of processes. A failure
+    in one file does not stop the others.
+
+    Args:
+        svg_paths (list): The SVG files.
+        rules (dict): The rules, as returned by `load_rules`.
+        output_dir (str or Path): Where the JSON files are written. Defaults to the
+            directory of each SVG file.
+        workers (int): The number of processes. Defaults to the number of CPUs.
+        report (callable): Called with each result tuple `(svg_path, json_path,
+            seconds, error)` as soon as it is available.
+        text_bbox_mode (str): How the bounding boxes of texts are computed, one of
+            `export.TEXT_BBOX_MODES`.
+        image_dir (str or Path): See `export_file`.
+        incremental (bool): See `export_file`.
+        output_format (str): See `export_file`.
+        profile (str): See `export_file`.
+
+    Returns:
+        list: The result tuples, in the same order as `svg_paths`.
+    """
+    if output_dir is not None:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                _export_worker,
+                path,
+                rules,
+                output_dir,
+                text_bbox_mode,
+                image_dir,
+                incremental,
+                output_format,
+                profile,
+            ): i
+            for i, path in enumerate(svg_paths)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            if report is not None:
+                report(result)
+    return [results[i] for i in range(len(svg_paths))]
+
+
+def _print_result(result):
+    svg_path, out, seconds, error = result
+    if error is None:
+        message = f"OK     {seconds:8.2f}s  {svg_path} -> {out}"
+        logging.info(message)
+    else:
+        message = f"FAILED {seconds:8.2f}s  {svg_path}\n{error}"
+        logging.error(message)
+    print(message, file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export the annotations of many SVG files without the GUI"
+    )
+    parser.add_argument(
+        "rules", help="JSON file with the rules, as saved by 'Export Rules'"
+    )
+    parser.add_argument(
+        "svgs", nargs="+", help="SVG files, directories or glob patterns"
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        default=None,
+        help="Directory for the JSON files (default: next to each SVG)",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--text-bbox",
+        choices=TEXT_BBOX_MODES,
+        default="inkscape",
+        help="How the bounding boxes of texts are computed: by a new Inkscape "
+        "process per file, by one long-lived Inkscape shell per worker (both exact), "
+        "or estimated from the installed fonts (fast, no Inkscape needed)",
+    )
+    parser.add_argument(
+        "--external-images",
+        nargs="?",
+        const="images",
+        default=None,
+        metavar="DIR",
+        help="Write embedded images to DIR (relative to the JSON files, default: "
+        "'images'), once per distinct image, and only refer to them in the JSON files",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only recompute the elements that changed since the previous export of "
+        "the same file (fingerprints are stored next to the JSON files)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="json",
+        help="Output format: one JSON file per SVG, or one directory of columns "
+        "(NumPy arrays that can be memory-mapped) per SVG",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=profiling.PROFILE_MODES,
+        default=profiling.mode_from_environment(),
+        help="Log the time of each stage of the export and the work done ('info': "
+        "also add them to the 'info' of the JSON files); the default is taken from "
+        "the environment variable LAUDARE_PROFILE",
+    )
+    args = parser.parse_args(argv)
+    utils.setup()
+    if args.format == "columnar" and args.incremental:
+        parser.error("--incremental cannot be used with --format columnar")
+
+    rules = load_rules(args.rules)
+    svg_paths = expand_paths(args.svgs)
+    if len(svg_paths) == 0:
+        parser.error("No SVG file found")
+
+    start = time.perf_counter()
+    results = batch_export(
+        svg_paths,
+        rules,
+        output_dir=args.output_dir,
+        workers=args.workers,
+        report=_print_result,
+        text_bbox_mode=args.text_bbox,
+        image_dir=args.external_images,
+        incremental=args.incremental,
+        output_format=args.format,
+        profile=args.profile,
+    )
+    failed = [r for r in results if r[3] is not None]
+    print(
+        f"Exported {len(results) - len(failed)}/{len(results)} files "
+        f"in {time.perf_counter() - start:.2f}s",
+        file=sys.stderr,
+    )
+    for svg_path, *_ in failed:
+        print(f"Failed: {svg_path}", file=sys.stderr)
+    return 1 if failed else 0
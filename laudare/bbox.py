@@ -0,0 +1,133 @@
+"""
+A module for computing the bounding boxes of many nodes of a document in time linear in
+the size of the tree.
+
+The transform of each node composed with those of its ancestors is computed once, from
+its parent's, and the bounding box of each node is computed once: the bounding box of a
+group is the union of the (cached) bounding boxes of its children, as in inkex, instead
+of being recomputed from the leaves for every group.
+"""
+
+import contextlib
+
+import inkex
+from inkex.elements._groups import GroupBase
+from inkex.transforms import Transform
+
+from . import profiling
+
+
+def own_transform(node):
+    """The transform of `node` alone, parsed from the raw attribute (`node.transform`
+    and `node.get` rewrite the attribute in the normalized form of inkex)"""
+    return Transform(node.attrib.get("transform"))
+
+
+def composed_transform(node):
+    """The transform of `node` composed with those of its ancestors (the root is left
+    out), like `node.composed_transform()` but without modifying the document"""
+    transform = Transform()
+    while node.getparent() is not None:
+        transform = own_transform(node) @ transform
+        node = node.getparent()
+    return transform
+
+
+@contextlib.contextmanager
+def _raw_transforms(nodes):
+    """Restores the raw `transform` attributes of `nodes` on exit"""
+    nodes = list(nodes)
+    raw = [node.attrib.get("transform") for node in nodes]
+    try:
+        yield
+    finally:
+        for node, value in zip(nodes, raw):
+            if value is None:
+                node.attrib.pop("transform", None)
+            elif node.attrib.get("transform") != value:
+                node.attrib["transform"] = value
+
+
+def bounding_box(node, transform):
+    """
+    Returns `node.bounding_box(transform)` without modifying the document: inkex
+    rewrites the `transform` attribute of every node that it reads (e.g.
+    `scale(0.8)` becomes `scale(0.8, 0.8)`), which would change the SVG written by
+    Inkscape and the fingerprints of the nodes.
+    """
+    own = own_transform(node)
+    if isinstance(node, GroupBase):
+        effective = transform @ own
+        bbox = None
+        for child in node:
+            if isinstance(child, inkex.ShapeElement) and child.is_visible():
+                child_bbox = bounding_box(child, effective)
+                if child_bbox is not None:
+                    bbox += child_bbox
+    elif type(node).shape_box is inkex.ShapeElement.shape_box:
+        # the box of the path, as in `ShapeElement.shape_box`
+        bbox = node.path.to_absolute().transform(own).transform(transform)
+        bbox = bbox.bounding_box()
+    elif isinstance(node, inkex.Use):
+        # the box of the cloned node, as in `Use.shape_box`
+        href = node.href
+        bbox = None if href is None else bounding_box(href, transform @ own)
+    else:
+        # texts also read the transforms of their tspans
+        with _raw_transforms(node.iter()):
+            bbox = node.shape_box(transform)
+    clip = node.clip
+    if clip is None or bbox is None:
+        return bbox
+    return bbox & bounding_box(clip, transform @ own)
+
+
+class BoundingBoxes:
+    """
+    Memoized bounding boxes of the nodes of a document, in the coordinates of the
+    document (all the transforms of the node and of its ancestors are applied, the
+    view box is not). The result for a node is the same as `node.bounding_box()`
+    when none of its ancestors has a transform.
+    """
+
+    def __init__(self):
+        self._transforms = {}
+        self._bboxes = {}
+
+    def transform(self, node):
+        """The transform of `node` composed with those of its ancestors (the root is
+        left out)"""
+        transform = self._transforms.get(node)
+        if transform is None:
+            parent = node.getparent()
+            if parent is None:
+                transform = Transform()
+            else:
+                transform = self.transform(parent) @ own_transform(node)
+            self._transforms[node] = transform
+        return transform
+
+    def parent_transform(self, node):
+        parent = node.getparent()
+        return Transform() if parent is None else self.transform(parent)
+
+    def bbox(self, node):
+        """Returns the `BoundingBox` of `node`, or None if it has no extent"""
+        if node in self._bboxes:
+            return self._bboxes[node]
+        profiling.count("bboxes computed")
+        if isinstance(node, GroupBase):
+            # same as GroupBase.bounding_box, but reusing the boxes of the children
+            bbox = None
+            for child in node:
+                if isinstance(child, inkex.ShapeElement) and child.is_visible():
+                    child_bbox = self.bbox(child)
+                    if child_bbox is not None:
+                        bbox += child_bbox
+            clip = node.clip
+            if clip is not None and bbox is not None:
+                bbox = bbox & bounding_box(clip, self.transform(node))
+        else:
+            bbox = bounding_box(node, self.parent_transform(node))
+        self._bboxes[node] = bbox
+        return bbox
@@ -0,0 +1,155 @@
+"""A module for caching results on disk across the runs of the extensions."""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from .paths import get_cache_dir
+
+
+class DiskCache:
+    """
+    A size-bounded key-value store kept in a single SQLite file. When the total size
+    of the values exceeds `max_bytes`, the least recently used entries are evicted.
+
+    The number of hits and misses is stored in the same file, so that the
+    statistics cover all the runs. The file can be shared by concurrent processes:
+    each operation is a short transaction and writers wait for each other.
+
+    Args:
+        path (str or Path): The SQLite file.
+        max_bytes (int): The maximum total size of the values.
+    """
+
+    def __init__(self, path, max_bytes=64 * 2**20):
+        self.path = path
+        self.max_bytes = max_bytes
+        # the connection of each thread: sqlite3 does not allow a connection to be
+        # used by another thread (e.g. the next export started from the GUI)
+        self._local = threading.local()
+
+    def _connect(self):
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            # a connection must not be shared with a forked process
+            local.connection = None
+        if local.connection is None:
+            connection = sqlite3.connect(str(self.path), timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)"
+            )
+            connection.commit()
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
+
+    def _count(self, connection, name, n=1):
+        if n == 0:
+            return
+        connection.execute(
+            "INSERT INTO stats VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, n),
+        )
+
+    def get(self, key):
+        """Returns the value stored for `key`, or None"""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Returns a dict with the values stored for the `keys` that are in the
+        cache, reading them in a single transaction"""
+        keys = list(keys)
+        connection = self._connect()
+        values = {}
+        with connection:
+            for key in keys:
+                row = connection.execute(
+                    "SELECT value FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    values[key] = row[0]
+            now = time.time()
+            connection.executemany(
+                "UPDATE entries SET last_access = ? WHERE key = ?",
+                [(now, key) for key in values],
+            )
+            self._count(connection, "hits", len(values))
+            self._count(connection, "misses", len(keys) - len(values))
+        return values
+
+    def set(self, key, value):
+        """Stores `value` (bytes or str) for `key`, evicting the least recently used
+        entries if the cache gets too big"""
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        """Stores the values of the dict `items` in a single transaction, see
+        `set`"""
+        connection = self._connect()
+        with connection:
+            now = time.time()
+            connection.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                [(key, value, len(value), now) for key, value in items.items()],
+            )
+            total = connection.execute("SELECT SUM(size) FROM entries").fetchone()[0]
+            if total is not None and total > self.max_bytes:
+                evicted = 0
+                for old_key, size in connection.execute(
+                    "SELECT key, size FROM entries ORDER BY last_access"
+                ).fetchall():
+                    if total <= self.max_bytes or old_key in items:
+                        break
+                    connection.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+                    total -= size
+                    evicted += 1
+                logging.info(f"Cache {self.path}: evicted {evicted} entries")
+
+    def stats(self):
+        """Returns a dict with the number of entries, their total size and the number
+        of hits and misses"""
+        connection = self._connect()
+        entries, size = connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        stats = dict(connection.execute("SELECT name, value FROM stats").fetchall())
+        return {
+            "entries": entries,
+            "bytes": size,
+            "hits": stats.get("hits", 0),
+            "misses": stats.get("misses", 0),
+        }
+
+    def log_stats(self, prefix=""):
+        stats = self.stats()
+        logging.info(
+            f"{prefix}cache {self.path}: {stats['hits']} hits, {stats['misses']} "
+            f"misses, {stats['entries']} entries, {stats['bytes']} bytes"
+        )
+
+    def close(self):
+        """Closes the connection of this thread, if any"""
+        if getattr(self._local, "connection", None) is not None:
+            self._local.connection.close()
+            self._local.connection = None
+
+
+_caches = {}
+
+
+def get_cache(name, max_bytes=64 * 2**20):
+    """Returns the `DiskCache` named `name` in `paths.get_cache_dir()`, opening it
+    only once per process"""
+    if name not in _caches:
+        _caches[name] = DiskCache(
+            get_cache_dir() / f"{name}.sqlite", max_bytes=max_bytes
+        )
+    return _caches[name]
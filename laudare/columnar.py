@@ -0,0 +1,317 @@
+"""
+A module for storing the annotations as flat columns instead of nested JSON, so that
+they can be memory-mapped and filtered without parsing JSON.
+
+The annotations of a page are stored in a directory (by convention `<name>.columns`)
+with one row per annotated element or group, in the same order as in the JSON format:
+
+- `meta.json`: the format version, the labels (`name`, `color`, `shape`) and the
+  number of rows and edges;
+- `info.json`: the "info" of the JSON format (it may contain the whole image);
+- `label.npy` (int32): the index of the label of each row in `meta["labels"]`;
+- `group.npy` (bool): whether each row is a group;
+- `x.npy`, `y.npy`, `w.npy`, `h.npy` (float64): the bounding box of each row;
+- `id`, `text`: string columns, each stored as `<name>.offsets.npy` (int64, one more
+  than the rows) and `<name>.data.npy` (the UTF-8 bytes of all the strings); string `i`
+  is `data[offsets[i]:offsets[i + 1]]`. `text_valid.npy` (bool) is False where the
+  text is null;
+- `edge_parent.npy` (int64), `edge_child.npy` (int64) and the string column
+  `edge_child_id`: the children of the rows, one edge per child, in order. The child
+  is the row of the first element with the id, or -1 if the child is not annotated.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+from .jsonstream import write_dict
+from .paths import expand_paths
+
+VERSION = 1
+SUFFIX = ".columns"
+FLOAT_COLUMNS = ("x", "y", "w", "h")
+
+
+def _save(directory, name, column, dtype):
+    """Saves an `array` or `bytearray` as `<name>.npy`"""
+    values = np.frombuffer(column, dtype if dtype is not bool else np.int8)
+    np.save(directory / f"{name}.npy", values.astype(dtype, copy=False))
+
+
+class StringColumn:
+    """A column of strings being built, saved as `<name>.offsets.npy` and
+    `<name>.data.npy`, see `decode_strings`"""
+
+    def __init__(self):
+        self.offsets = array("q", [0])
+        self.data = bytearray()
+
+    def append(self, string):
+        self.data += string.encode("utf-8")
+        self.offsets.append(len(self.data))
+
+    def save(self, directory, name):
+        _save(directory, f"{name}.offsets", self.offsets, np.int64)
+        _save(directory, f"{name}.data", self.data, np.uint8)
+
+
+def decode_strings(offsets, data):
+    """Decodes all the strings of a string column saved by `StringColumn`"""
+    data = data.tobytes()
+    return [
+        data[start:end].decode("utf-8")
+        for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())
+    ]
+
+
+class ColumnarWriter:
+    """
+    Same interface as `jsonstream.AnnotationWriter`, but writes the annotations in
+    the columnar format into `directory` when it is closed. The columns are
+    accumulated in `array`s, which are much smaller than the equivalent dicts.
+
+    Args:
+        directory (str or Path): The output directory, created if needed.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.info = None
+        self.labels = []
+        self._group = False
+        self.label = array("i")
+        self.is_group = array("b")
+        self.floats = {name: array("d") for name in FLOAT_COLUMNS}
+        self.ids = StringColumn()
+        self.texts = StringColumn()
+        self.text_valid = array("b")
+        self.edge_parent = array("q")
+        self.edge_child_ids = StringColumn()
+        self._children = []
+
+    def write_info(self, info):
+        self.info = info
+
+    def begin_label(self, label, color, shape):
+        self.labels.append({"name": label, "color": color, "shape": shape})
+        self._group = False
+
+    def add(self, key, annotation):
+        row = len(self.label)
+        self.label.append(len(self.labels) - 1)
+        self.is_group.append(self._group)
+        for name in FLOAT_COLUMNS:
+            self.floats[name].append(annotation[name])
+        self.ids.append(key)
+        text = annotation["text"]
+        self.texts.append(text or "")
+        self.text_valid.append(text is not None)
+        for child in annotation["children"]:
+            self.edge_parent.append(row)
+            self.edge_child_ids.append(child)
+            self._children.append(child)
+
+    def begin_groups(self):
+        self._group = True
+
+    def end_label(self):
+        pass
+
+    def _child_rows(self):
+        element_rows = {}
+        id_data = bytes(self.ids.data)
+        for row, is_group in enumerate(self.is_group):
+            if not is_group:
+                start, end = self.ids.offsets[row], self.ids.offsets[row + 1]
+                element_rows.setdefault(id_data[start:end].decode("utf-8"), row)
+        return array("q", (element_rows.get(child, -1) for child in self._children))
+
+    def close(self):
+        # the columns are written in a temporary directory that then replaces
+        # `self.directory`, so that a failed export does not destroy a previous one
+        self.directory.parent.mkdir(parents=True, exist_ok=True)
+        directory = Path(
+            tempfile.mkdtemp(dir=self.directory.parent, prefix=self.directory.name)
+        )
+        try:
+            self._write(directory)
+        except BaseException:
+            shutil.rmtree(directory)
+            raise
+        if self.directory.exists():
+            old = Path(
+                tempfile.mkdtemp(dir=self.directory.parent, prefix=self.directory.name)
+            )
+            os.replace(self.directory, old / "old")
+            os.replace(directory, self.directory)
+            shutil.rmtree(old)
+        else:
+            os.replace(directory, self.directory)
+
+    def _write(self, directory):
+        _save(directory, "label", self.label, np.int32)
+        _save(directory, "group", self.is_group, bool)
+        for name, column in self.floats.items():
+            _save(directory, name, column, np.float64)
+        self.ids.save(directory, "id")
+        self.texts.save(directory, "text")
+        _save(directory, "text_valid", self.text_valid, bool)
+        _save(directory, "edge_parent", self.edge_parent, np.int64)
+        _save(directory, "edge_child", self._child_rows(), np.int64)
+        self.edge_child_ids.save(directory, "edge_child_id")
+        with open(directory / "info.json", "w") as f:
+            json.dump(self.info, f)
+        # written last: a directory without meta.json is incomplete
+        with open(directory / "meta.json", "w") as f:
+            json.dump(
+                {
+                    "version": VERSION,
+                    "labels": self.labels,
+                    "rows": len(self.label),
+                    "edges": len(self.edge_parent),
+                },
+                f,
+            )
+
+
+class ColumnarAnnotations:
+    """
+    The annotations of a page in the columnar format, see the module documentation.
+    The columns are attributes (`label`, `group`, `x`, `y`, `w`, `h`, `text_valid`,
+    `edge_parent`, `edge_child`) and are memory-mapped by default; string columns
+    are decoded on demand with `string` and `strings`.
+
+    Args:
+        directory (str or Path): The directory written by `ColumnarWriter`.
+        mmap_mode (str): Passed to `numpy.load`; None loads the columns in memory.
+    """
+
+    def __init__(self, directory, mmap_mode="r"):
+        self.directory = Path(directory)
+        with open(self.directory / "meta.json", "r") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != VERSION:
+            raise ValueError(f"Unsupported columnar version {self.meta['version']}")
+        self.labels = self.meta["labels"]
+
+        def load(name):
+            return np.load(self.directory / f"{name}.npy", mmap_mode=mmap_mode)
+
+        self.label = load("label")
+        self.group = load("group")
+        for name in FLOAT_COLUMNS:
+            setattr(self, name, load(name))
+        self.text_valid = load("text_valid")
+        self.edge_parent = load("edge_parent")
+        self.edge_child = load("edge_child")
+        self._strings = {
+            name: (load(f"{name}.offsets"), load(f"{name}.data"))
+            for name in ("id", "text", "edge_child_id")
+        }
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def string(self, column, i):
+        """Returns the string `i` of the string column `column` ("id", "text" or
+        "edge_child_id"); texts that are null are returned as None"""
+        if column == "text" and not self.text_valid[i]:
+            return None
+        offsets, data = self._strings[column]
+        return data[offsets[i] : offsets[i + 1]].tobytes().decode("utf-8")
+
+    def strings(self, column):
+        """Returns all the strings of a string column as a list"""
+        strings = decode_strings(*self._strings[column])
+        if column == "text":
+            strings = [s if v else None for s, v in zip(strings, self.text_valid)]
+        return strings
+
+    def info(self):
+        with open(self.directory / "info.json", "r") as f:
+            return json.load(f)
+
+    def to_dict(self):
+        """Rebuilds the annotations in the JSON format"""
+        ids = self.strings("id")
+        texts = self.strings("text")
+        child_ids = self.strings("edge_child_id")
+        children = [[] for _ in range(len(self))]
+        for parent, child in zip(self.edge_parent.tolist(), child_ids):
+            children[parent].append(child)
+        annotations = {
+            label["name"]: {
+                "color": label["color"],
+                "shape": label["shape"],
+                "elements": {},
+                "groups": {},
+            }
+            for label in self.labels
+        }
+        floats = {name: getattr(self, name).tolist() for name in FLOAT_COLUMNS}
+        for row, (label, group) in enumerate(
+            zip(self.label.tolist(), self.group.tolist())
+        ):
+            section = "groups" if group else "elements"
+            annotations[self.labels[label]["name"]][section][ids[row]] = {
+                "x": floats["x"][row],
+                "y": floats["y"][row],
+                "w": floats["w"][row],
+                "h": floats["h"][row],
+                "text": texts[row],
+                "children": children[row],
+            }
+        return {"info": self.info(), "annotations": annotations}
+
+
+def convert_json(json_path, output_dir=None):
+    """
+    Converts a JSON annotation file into the columnar format.
+
+    Args:
+        json_path (str or Path): The JSON file.
+        output_dir (str or Path): Where the `.columns` directory is written. Defaults
+            to the directory of the JSON file.
+
+    Returns:
+        Path: The directory written.
+    """
+    json_path = Path(json_path)
+    output_dir = json_path.parent if output_dir is None else Path(output_dir)
+    out = output_dir / (json_path.stem + SUFFIX)
+    with open(json_path, "r") as f:
+        data = json.load(f)
+    write_dict(data, ColumnarWriter(out))
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert Laudare JSON files into the columnar format"
+    )
+    parser.add_argument(
+        "jsons", nargs="+", help="JSON files, directories or glob patterns"
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        default=None,
+        help="Directory for the .columns directories (default: next to each JSON)",
+    )
+    args = parser.parse_args(argv)
+
+    paths = expand_paths(args.jsons, suffix=".json")
+    paths = [p for p in paths if not p.name.endswith(".fingerprints.json")]
+    if len(paths) == 0:
+        parser.error("No JSON file found")
+    for path in paths:
+        out = convert_json(path, args.output_dir)
+        print(f"{path} -> {out}", file=sys.stderr)
+    return 0
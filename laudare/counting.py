@@ -0,0 +1,303 @@
+"""
+A module for counting the annotations of many Laudare JSON files, independent of any
+GUI.
+
+Files are counted in parallel by a pool of processes, and each file is scanned without
+parsing its "info" (which may contain a base64 image of tens of MB): the file is
+memory-mapped, the top-level keys are located with a small event-based scanner, and only
+the "annotations" value is decoded. Optionally, the counts of each file are cached on
+disk, so that only the files that changed since the previous run are parsed.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+from collections import defaultdict
+from pathlib import Path
+
+KIND_LABEL = "label"
+KIND_GROUP = "group"
+KIND_TEXT = "text"
+
+_WHITESPACE = re.compile(rb"\s*")
+# the loop is unrolled so that long strings are skipped by a single character class
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+_STRING_OR_BRACKET = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]', re.S)
+_SCALAR = re.compile(rb"[^,\]}\s]+")
+
+
+def count_annotations(data: dict):
+    """
+    Counts the elements and groups of each label and the texts of the elements in
+    the annotation `data`.
+
+    Returns:
+        defaultdict: The counts, with keys `(kind, key)` where kind is one of
+            `KIND_LABEL`, `KIND_GROUP`, `KIND_TEXT`.
+    """
+    counts = defaultdict(int)
+    for label, annotations in data["annotations"].items():
+        counts[(KIND_LABEL, label)] += len(annotations["elements"])
+        counts[(KIND_GROUP, label)] += len(annotations["groups"])
+        for item in annotations["elements"].values():
+            text = item["text"]
+            # here < 10 is to protect against very long texts...
+            if text is not None and len(text) < 10:
+                counts[(KIND_TEXT, text)] += 1
+    return counts
+
+
+def flatten_counts(counts):
+    """Converts counts with `(kind, key)` keys to the flat format shown in the
+    counts dialog: `label`, `label - group` and `text`"""
+    flat = defaultdict(int)
+    for (kind, key), value in counts.items():
+        if kind == KIND_GROUP:
+            key = key + " - group"
+        flat[key] += value
+    return flat
+
+
+def merge_counts(parts):
+    """Sums a list of counts by merging them pairwise, in a tree reduction. Keys with
+    zero counts are kept."""
+    parts = list(parts)
+    if len(parts) == 0:
+        return defaultdict(int)
+    while len(parts) > 1:
+        merged = []
+        for i in range(0, len(parts) - 1, 2):
+            left, right = parts[i], parts[i + 1]
+            if len(left) < len(right):
+                left, right = right, left
+            for key, value in right.items():
+                left[key] = left.get(key, 0) + value
+            merged.append(left)
+        if len(parts) % 2 == 1:
+            merged.append(parts[-1])
+        parts = merged
+    return parts[0]
+
+
+def _skip_whitespace(buf, pos):
+    return _WHITESPACE.match(buf, pos).end()
+
+
+def _skip_value(buf, pos):
+    """Returns the position after the JSON value starting at `pos`, without decoding
+    it"""
+    first = buf[pos : pos + 1]
+    if first == b'"':
+        return _STRING.match(buf, pos).end()
+    elif first in (b"{", b"["):
+        depth = 0
+        for match in _STRING_OR_BRACKET.finditer(buf, pos):
+            token = buf[match.start()]
+            if token in b"{[":
+                depth += 1
+            elif token in b"}]":
+                depth -= 1
+                if depth == 0:
+                    return match.end()
+        raise ValueError("Unterminated JSON value")
+    match = _SCALAR.match(buf, pos)
+    if match is None:
+        raise ValueError(f"Invalid JSON value at {pos}")
+    return match.end()
+
+
+def iter_top_level(buf):
+    """Yields `(key, start, end)` for each key of the top-level JSON object in `buf`,
+    where `buf[start:end]` is the undecoded value"""
+    pos = _skip_whitespace(buf, 0)
+    if buf[pos : pos + 1] != b"{":
+        raise ValueError("Not a JSON object")
+    pos = _skip_whitespace(buf, pos + 1)
+    if buf[pos : pos + 1] == b"}":
+        return
+    while True:
+        match = _STRING.match(buf, pos)
+        if match is None:
+            raise ValueError(f"Expected a key at {pos}")
+        key = json.loads(buf[match.start() : match.end()])
+        pos = _skip_whitespace(buf, match.end())
+        if buf[pos : pos + 1] != b":":
+            raise ValueError(f"Expected ':' at {pos}")
+        start = _skip_whitespace(buf, pos + 1)
+        end = _skip_value(buf, start)
+        yield key, start, end
+        pos = _skip_whitespace(buf, end)
+        separator = buf[pos : pos + 1]
+        if separator == b"}":
+            return
+        elif separator != b",":
+            raise ValueError(f"Expected ',' or '}}' at {pos}")
+        pos = _skip_whitespace(buf, pos + 1)
+
+
+def load_annotations_only(path):
+    """Loads the "annotations" of a Laudare JSON file, skipping the "info" without
+    decoding it. Returns a dict with only the "annotations" key."""
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for key, start, end in iter_top_level(buf):
+                if key == "annotations":
+                    return {"annotations": json.loads(buf[start:end])}
+    raise ValueError(f"No annotations in {path}")
+
+
+def count_file(path):
+    """Counts the annotations of a single file, see `count_annotations`"""
+    return count_annotations(load_annotations_only(path))
+
+
+def file_digest(path):
+    """The SHA-256 of the content of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _encode_entry(state, digest, counts):
+    mtime_ns, size = state
+    return json.dumps(
+        {
+            "mtime_ns": mtime_ns,
+            "size": size,
+            "sha256": digest,
+            "counts": [[kind, key, value] for (kind, key), value in counts.items()],
+        }
+    )
+
+
+def _decode_counts(entry):
+    counts = defaultdict(int)
+    for kind, key, value in entry["counts"]:
+        counts[(kind, key)] = value
+    return counts
+
+
+def _file_state(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _count_chunk(paths, previous=None):
+    """
+    Counts a chunk of files in a worker process; returns the counts of each file, the
+    hash of its content, their sum, and the error of each file that could not be
+    counted (e.g. empty or truncated), which is left out of the sum.
+
+    If `previous` is given, it contains the cache entry of each file (or None): the
+    files are hashed, and those whose content did not change are not parsed.
+    """
+    per_file = []
+    failed = []
+    for i, path in enumerate(paths):
+        try:
+            if previous is None:
+                per_file.append((path, count_file(path), None))
+                continue
+            digest = file_digest(path)
+            entry = previous[i]
+            if entry is not None and entry["sha256"] == digest:
+                counts = _decode_counts(entry)
+            else:
+                counts = count_file(path)
+            per_file.append((path, counts, digest))
+        except Exception as e:
+            failed.append((path, f"{type(e).__name__}: {e}"))
+    total = merge_counts([dict(counts) for _, counts, _ in per_file])
+    return per_file, total, failed
+
+
+def count_files(paths, workers=None, chunk_size=32, use_cache=False):
+    """
+    Counts the annotations of many files using a pool of processes. Each process
+    counts chunks of `chunk_size` files and sums them; the partial sums are then
+    merged in a tree reduction. Few files are counted in this process.
+
+    If `use_cache` is True, the counts of each file are stored in the cache "counts"
+    (see `cache.get_cache`) with the modification time, size and hash of the file: a
+    file whose modification time and size did not change is not read again, and one
+    whose content did not change is not parsed again.
+
+    A file that cannot be counted (e.g. empty, truncated or not a Laudare JSON file)
+    does not stop the others: it is left out of the counts and its error is returned.
+
+    Returns:
+        tuple: The total counts, a dict `{path: counts}` (see `count_annotations`)
+            and a dict `{path: error}` of the files that could not be counted.
+    """
+    paths = list(paths)
+    cached = {}
+    failed = {}
+    todo, previous = paths, None
+    if use_cache:
+        # imported here, so that counting without the cache needs neither inkex nor
+        # numpy
+        from . import cache
+
+        disk_cache = cache.get_cache("counts")
+        states = {}
+        for path in paths:
+            try:
+                states[path] = _file_state(path)
+            except OSError as e:
+                failed[path] = f"{type(e).__name__}: {e}"
+        keys = {path: str(Path(path).resolve()) for path in states}
+        entries = disk_cache.get_many(set(keys.values()))
+        todo, previous = [], []
+        for path in states:
+            entry = entries.get(keys[path])
+            entry = None if entry is None else json.loads(entry)
+            if entry is not None and (entry["mtime_ns"], entry["size"]) == states[path]:
+                cached[path] = _decode_counts(entry)
+            else:
+                todo.append(path)
+                previous.append(entry)
+
+    chunks = [todo[i : i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    if previous is None:
+        previous_chunks = [None] * len(chunks)
+    else:
+        previous_chunks = [
+            previous[i : i + chunk_size] for i in range(0, len(todo), chunk_size)
+        ]
+    if len(chunks) <= 1:
+        results = [_count_chunk(*args) for args in zip(chunks, previous_chunks)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_count_chunk, chunks, previous_chunks))
+
+    counted = {}
+    updates = {}
+    for chunk_per_file, _, chunk_failed in results:
+        for path, counts, digest in chunk_per_file:
+            counted[path] = counts
+            if use_cache:
+                updates[keys[path]] = _encode_entry(states[path], digest, counts)
+        failed.update(chunk_failed)
+    if use_cache:
+        if len(updates) > 0:
+            disk_cache.set_many(updates)
+        logging.info(
+            f"Counted {len(paths)} files: {len(cached)} unchanged, "
+            f"{len(todo)} read again, {len(failed)} failed"
+        )
+    per_file = {
+        path: cached[path] if path in cached else counted[path]
+        for path in paths
+        if path not in failed
+    }
+    total = merge_counts(
+        [defaultdict(int, partial) for _, partial, _ in results]
+        + [defaultdict(int, counts) for counts in cached.values()]
+    )
+    return total, per_file, failed
@@ -1,19 +1,38 @@
-import concurrent.futures
+import collections.abc
 import datetime
 import getpass
+import hashlib
 import json
+import logging
+import shutil
+import sys
+import threading
 import warnings
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, TemporaryFile
 
 import inkex
 from inkex import units
 from inkex.command import inkscape, write_svg
 from inkex.transforms import BoundingBox
+from lxml import etree
 
-from . import gui, utils
+from . import cache, fonts, images, inkscape_shell, profiling, utils
+from .analysis import DocumentAnalysis
+from .bbox import composed_transform
+from .jsonstream import AnnotationWriter, DictWriter, write_dict
+from .matching import ColorIndex, CompiledRules, group_members
 
 warnings.filterwarnings("ignore")
 
+TEXT_BBOX_MODES = ("inkscape", "shell", "native")
+
+# the number of elements between two reports of the progress of an export
+PROGRESS_EVERY = 50
+
+
+class ExportCancelled(Exception):
+    """Raised by `LaudareExport.write_annotations` when `cancel_event` is set"""
+
 
 def to_px(value, unit):
     if unit != "px":
@@ -22,27 +41,17 @@ def to_px(value, unit):
         return value
 
 
-def bake_transforms_recursively(group, apply_to_paths=True):
-    """
-    Back-ported from inkex >= 1.4
-    """
-    for element in group:
-        if isinstance(element, inkex.PathElement) and apply_to_paths:
-            element.path = element.path.transform(group.transform)
-        else:
-            element.transform = group.transform @ element.transform
-            if isinstance(element, inkex.elements._groups.GroupBase):
-                bake_transforms_recursively(element, apply_to_paths)
-    group.transform = None
-
-
 def node_to_annotation(
-    node, children=[], relative_to=(0, 0), text_bboxes: dict[str, BoundingBox] = {}
+    node,
+    children=[],
+    relative_to=(0, 0),
+    text_bboxes: dict[str, BoundingBox] = {},
+    bbox=None,
 ):
     if node.tag_name == "text":
         bbox = text_bboxes[node.get_id()]
-    else:
-        bbox = node.bounding_box()
+    elif bbox is None:
+        bbox = node.bounding_box(composed_transform(node.getparent()))
     return {
         "x": to_px(bbox.left - relative_to[0], node.unit),
         "y": to_px(bbox.top - relative_to[1], node.unit),
@@ -53,22 +62,48 @@ def node_to_annotation(
     }
 
 
-def get_text_element_bounding_box(svg):
+def text_elements_hash(svg):
+    """Returns a hash of everything that can change the bounding boxes of the text
+    elements computed by Inkscape: the size of the document, the style sheets, and
+    each text element with its content, attributes (geometry, font, transform...),
+    the font properties that it inherits from its ancestors and the transform of its
+    ancestors"""
+    digest = hashlib.sha256()
+    for attr in ("width", "height", "viewBox"):
+        digest.update(f"{attr}={svg.get(attr)};".encode())
+    for node in svg.descendants():
+        if isinstance(node, inkex.StyleElement):
+            digest.update(etree.tostring(node, with_tail=False))
+        elif isinstance(node, inkex.TextElement):
+            digest.update(str(composed_transform(node.getparent())).encode())
+            style = node.specified_style()
+            for name in fonts.TEXT_PROPERTIES:
+                digest.update(f"{name}:{style.get(name)};".encode())
+            digest.update(etree.tostring(node, with_tail=False))
+    return digest.hexdigest()
+
+
+def _query_text_bounding_boxes(svg, use_shell=False):
     """Executes an external call to Inkscape and queries all the bounding boxes of all
-    the text elements. Returns a dict with keys the text elements ids starting with `#`
-    and with values a `BoundingBox` object"""
+    the text elements. Returns a dict with keys the element ids and with values a
+    `BoundingBox` object. If `use_shell` is True, the query is sent to a long-lived
+    Inkscape process (see `inkscape_shell`) instead of starting a new one"""
 
     outmap = {}
     with TemporaryDirectory(prefix="inkscape-command") as tmpdir:
         svg_file = write_svg(svg, tmpdir, "input.svg")
-        out = inkscape(svg_file, actions="select-by-element:text;query-all")
+        with profiling.span("inkscape query"):
+            if use_shell:
+                out = inkscape_shell.query_all(svg_file)
+            else:
+                out = inkscape(svg_file, actions="select-by-element:text;query-all")
 
         for line in out.strip().split("\n"):
             if line == "":
                 continue
             elements = line.split(",")
             if len(elements) != 5:
-                print("Error parsing line:", line + "%", file=__import__("sys").stderr)
+                print("Error parsing line:", line + "%", file=sys.stderr)
             element_id = elements[0]
             bbox = BoundingBox.new_xywh(
                 float(elements[1]),
@@ -78,28 +113,137 @@ def get_text_element_bounding_box(svg):
             )
             outmap[element_id] = bbox
 
+    profiling.count("texts queried", len(outmap))
     return outmap
 
 
+def get_text_element_bounding_box(svg, use_cache=True, mode="inkscape"):
+    """Returns a dict with keys the text elements ids and with values a `BoundingBox`
+    object.
+
+    If `mode` is "inkscape", the bounding boxes are computed by a new Inkscape
+    process; if it is "shell", by a long-lived Inkscape process shared by all the
+    exports of this process. In both cases, if `use_cache` is True, they are looked up
+    in a disk cache keyed by `text_elements_hash`, so that Inkscape is called only if
+    the text elements changed since a previous export. If `mode` is "native", the
+    bounding boxes are estimated in-process from the metrics of the installed fonts
+    (see `fonts`), which is much faster but less exact."""
+
+    if mode not in TEXT_BBOX_MODES:
+        raise ValueError(f"Unknown text bounding box mode: {mode}")
+    if mode == "native":
+        return fonts.estimate_text_bounding_boxes(svg)
+    if not use_cache:
+        return _query_text_bounding_boxes(svg, use_shell=mode == "shell")
+
+    bbox_cache = cache.get_cache("text_bboxes")
+    key = text_elements_hash(svg)
+    cached = bbox_cache.get(key)
+    if cached is not None:
+        profiling.count("text bbox cache hits")
+        outmap = {
+            element_id: BoundingBox((left, right), (top, bottom))
+            for element_id, (left, right, top, bottom) in json.loads(cached).items()
+        }
+    else:
+        outmap = _query_text_bounding_boxes(svg, use_shell=mode == "shell")
+        text_ids = {
+            node.get_id() for node in svg.descendants().filter(inkex.TextElement)
+        }
+        bbox_cache.set(
+            key,
+            json.dumps(
+                {
+                    element_id: (bbox.left, bbox.right, bbox.top, bbox.bottom)
+                    for element_id, bbox in outmap.items()
+                    if element_id in text_ids
+                }
+            ),
+        )
+    bbox_cache.log_stats("Text bounding boxes ")
+    return outmap
+
+
+class LazyTextBoundingBoxes(collections.abc.Mapping):
+    """The mapping returned by `get_text_element_bounding_box`, computed only when it
+    is first accessed, so that Inkscape is not called if no text is annotated"""
+
+    def __init__(self, svg, mode="inkscape"):
+        self.svg = svg
+        self.mode = mode
+        self._bboxes = None
+
+    def _get(self):
+        if self._bboxes is None:
+            with profiling.span("text bboxes"):
+                self._bboxes = get_text_element_bounding_box(self.svg, mode=self.mode)
+        return self._bboxes
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+
 class LaudareExport(inkex.extensions.OutputExtension):
     def __init__(self) -> None:
         super().__init__()
+        utils.setup()
         self.object_types = utils.SUPPORTED_TYPES
-        self.gui = gui.MainGui(
-            self.save_annotations,
-            "Save Annotations",
-            combovalues=sorted(self.object_types.keys()),
-        )
+        # how the bounding boxes of texts are computed, see TEXT_BBOX_MODES
+        self.text_bbox_mode = "inkscape"
+        # if set, embedded images are written in this directory instead of the JSON,
+        # and referred to with a path relative to `output_dir`, see `images`
+        self.image_dir = None
+        self.output_dir = "."
+        # if set, an `incremental.IncrementalExport` with the previous export, from
+        # which the annotations of the unchanged nodes are taken
+        self.incremental = None
+        # the `analysis.DocumentAnalysis` of `self.svg`, computed once
+        self.analysis = None
+        # one of `profiling.PROFILE_MODES`, see `write_annotations`
+        self.profile = profiling.mode_from_environment()
+        # the profile of the analysis run by `save` before the GUI is shown, continued
+        # by the first export
+        self._pending_profile = None
+        # if set, called with `(done, total, message)` while the annotations are
+        # written, at each label and every `PROGRESS_EVERY` elements; setting
+        # `cancel_event` stops the export at the next of these points
+        self.progress = None
+        self.cancel_event = threading.Event()
+        # the `gui.MainGui`, created by `save`: GTK is only imported when a window is
+        # shown, not when the annotations are exported from the command line
+        self.gui = None
 
     def save(self, stream):
         """
         Methods run when the user clicks on "Save"
         """
-        self.gui.set_palette(utils.get_svg_palette(self.svg))
+        from . import gui
+
+        self.gui = gui.MainGui(
+            self.save_annotations,
+            "Save Annotations",
+            combovalues=sorted(self.object_types.keys()),
+        )
+        # the analysis is needed for the palette before the export starts, so that
+        # it is measured into the profile of the export
+        if self.profile != "off":
+            self._pending_profile = profiling.start()
+        try:
+            with profiling.span("analysis"):
+                self.analysis = DocumentAnalysis(self.svg)
+        finally:
+            profiling.stop()
+        self.gui.set_palette(self.analysis.palette())
         self.gui.start()
 
-    def fill_info(self, all_elements, json_data):
-        image = all_elements.get(inkex.Image)
+    def fill_info(self, json_data):
+        image = self.analysis.nodes_of_type(inkex.Image)
         if len(image) > 1:
             raise RuntimeError("SVG has multiple images, not supported")
         elif len(image) == 0:
@@ -107,11 +251,18 @@ class LaudareExport(inkex.extensions.OutputExtension):
         else:
             image = image[0]
         # compute the size of the image, considering transforms
-        image_bbox = image.bounding_box()
+        image_bbox = self.analysis.bboxes.bbox(image)
         self._image_x = image_bbox.left
         self._image_y = image_bbox.top
 
         unit = self.svg.unit
+        # href may be preceeded by {...} # this can be base4 binary encoding!
+        href = next(v for k, v in image.attrib.items() if k.endswith("href"))
+        digest = None
+        if self.image_dir is not None:
+            href, digest = images.externalize_image(
+                href, self.image_dir, relative_to=self.output_dir
+            )
         # inserting metadata
         json_data["info"] = {
             "unit": "px",
@@ -124,92 +275,199 @@ class LaudareExport(inkex.extensions.OutputExtension):
                     to_px(image_bbox.width, unit),
                     to_px(image_bbox.height, unit),
                 ),
-                "href": next(
-                    v for k, v in image.attrib.items() if k.endswith("href")
-                ),  # href may be preceeded by {...} # this can be base4 binary encoding!
+                "href": href,
             },
         }
+        if digest is not None:
+            json_data["info"]["image"]["sha256"] = digest
 
-    def insert_groups(self, all_groups, obj_elements_color, json_data, label):
-        # iterate all groups and selects only those that contain obj with
-        # color
+    def group_annotations(self, all_groups, obj_elements_color):
+        """Yields `(id, annotation)` for the groups that contain more than one element
+        of `obj_elements_color` (a list of `analysis.NodeRecord`)"""
+        # charge each element to all of its ancestors, then selects only the groups
+        # that contain more than one obj with color
+        members = group_members([record.node for record in obj_elements_color])
         for group in all_groups:
             if group.groupmode == "layer":
                 continue
-            grouped_nodes = [
-                node for node in group.descendants() if node in obj_elements_color
-            ]
+            grouped_nodes = members.get(group, [])
             if len(grouped_nodes) > 1:
-                json_data["annotations"][label]["groups"][
-                    group.get_id()
-                ] = node_to_annotation(
-                    group,
-                    children=grouped_nodes,
+                id = group.get_id()
+                annotation = self._reuse(id)
+                if annotation is not None:
+                    # the membership depends on the rule, the bounding box does not
+                    annotation = dict(
+                        annotation, children=[c.get_id() for c in grouped_nodes]
+                    )
+                else:
+                    annotation = node_to_annotation(
+                        group,
+                        children=grouped_nodes,
+                        relative_to=(self._image_x, self._image_y),
+                        bbox=self.analysis.bboxes.bbox(group),
+                    )
+                yield id, annotation
+
+    def element_annotations(self, obj_elements_color):
+        """Yields `(id, annotation)` for each element of `obj_elements_color` (a list
+        of `analysis.NodeRecord`)"""
+        for record in obj_elements_color:
+            id = record.node.get_id()
+            annotation = self._reuse(id)
+            if annotation is None:
+                annotation = node_to_annotation(
+                    record.node,
                     relative_to=(self._image_x, self._image_y),
+                    text_bboxes=self.text_bboxes,
+                    bbox=record.bbox if record.tag != "text" else None,
                 )
+            yield id, annotation
 
-    def insert_elements(self, json_data, label, obj_elements_color):
-        # add the element to the json data
-        for node in obj_elements_color:
-            id = node.get_id()
-            json_data["annotations"][label]["elements"][id] = node_to_annotation(
-                node,
-                relative_to=(self._image_x, self._image_y),
-                text_bboxes=self.text_bboxes,
-            )
+    def _reuse(self, id):
+        """Returns the annotation of the previous export if the node did not change
+        and the export is incremental, otherwise None"""
+        if self.incremental is None:
+            return None
+        return self.incremental.reuse(id)
+
+    def _report_progress(self, done, total, message):
+        """Passes the progress to `self.progress`, if set, and raises
+        `ExportCancelled` if `self.cancel_event` is set"""
+        if self.cancel_event.is_set():
+            raise ExportCancelled("The export was cancelled")
+        if self.progress is not None:
+            self.progress(done, total, message)
+
+    def write_annotations(self, rules, writer):
+        """Compute the annotations of `self.svg` according to `rules` and write them
+        with `writer` as soon as they are computed.
+
+        If `self.profile` is not "off", the time of each stage and the work done are
+        measured (see `profiling`) and logged; if it is "info", they are also added
+        to the "info" of the annotations as "profile", and the annotations are then
+        written only at the end.
+
+        Args:
+            rules (dict): A dict `{label: [shape, color, isgroup, match,
+                priority]}`, as returned by `gui.MainGui.get_rule_dict` and stored by
+                `gui.MainGui.save_config`; it is checked and completed with
+                `utils.check_rule_dict`.
+            writer: A `jsonstream.AnnotationWriter` or `jsonstream.DictWriter`.
+        """
+        rules = utils.check_rule_dict(rules)
+        if self.profile == "off":
+            self._write_annotations(rules, writer)
+            return
 
-    def save_annotations(self, callback=None, args=None):
-        """Export the SVG file itself into the JSON file, using the rules defined
-        by the widgets and destroy the window"""
+        profile = profiling.start(self._pending_profile)
+        self._pending_profile = None
         try:
+            output = DictWriter() if self.profile == "info" else writer
+            with profiling.span("export"):
+                self._write_annotations(rules, output)
+        finally:
+            profiling.stop()
+        logging.info(f"Profile of the export:\n{profile.report()}")
+        if self.profile == "info":
+            output.data["info"]["profile"] = profile.to_dict()
+            write_dict(output.data, writer)
 
+    def _write_annotations(self, rules, writer):
+        if self.incremental is not None:
+            with profiling.span("incremental update"):
+                self.incremental.update(self.svg, self.text_bbox_mode)
+        if self.analysis is None:
+            with profiling.span("analysis"):
+                self.analysis = DocumentAnalysis(self.svg)
+        profiling.count("nodes scanned", len(self.analysis.records))
+        self.text_bboxes = LazyTextBoundingBoxes(self.svg, mode=self.text_bbox_mode)
+
+        # the document is not modified: the transforms of the ancestors are resolved
+        # by `self.analysis.bboxes`
+        all_groups = self.analysis.nodes_of_type(inkex.Group)
+
+        with profiling.span("info"):
             json_data = {}
-            all_elements = self.svg.descendants()
-            self.text_bboxes = get_text_element_bounding_box(self.svg)
-
-            all_groups = all_elements.get(inkex.Group)
-            for g in all_groups:
-                # apply transforms to lement, and remove them from groups
-                bake_transforms_recursively(g)
-
-            self.fill_info(all_elements, json_data)
-
-            # inserting annotations
-            json_data["annotations"] = {}
-            for label, (obj, color, isgroup) in self.gui.get_rule_dict().items():
-                # get all elements of type obj
-                inkex_class = self.object_types[obj]
-                obj_elements = all_elements.get(inkex_class)
-
-                # get only elements with this color in stroke *or* fill
-                obj_elements_color = []
-                for node in obj_elements:
-                    color_fill = utils.get_node_color(node, "fill")
-                    color_stroke = utils.get_node_color(node, "stroke")
-
-                    if utils.match_colors(color, color_fill, color_stroke):
-                        obj_elements_color.append(node)
-
-                json_data["annotations"][label] = {
-                    "color": color,
-                    "shape": obj,
-                    "elements": {},
-                    "groups": {},
-                }
+            self.fill_info(json_data)
+            writer.write_info(json_data.pop("info"))
 
-                if not isgroup:
-                    self.insert_elements(json_data, label, obj_elements_color)
-                else:
-                    self.insert_groups(all_groups, obj_elements_color, json_data, label)
-
-            json_string = json.dumps(json_data)
-            print(json_string)
-            if callback is not None:
-                callback(*args)
-            self.gui.stop()
-        except Exception as e:
-            # print stacktrace to stderr
-            import traceback
-            print(traceback.format_exc(), file=__import__("sys").stderr)
-            # show the exception in a dialog
-            gui.show_exception_dialog(e)
+        # index the shapes used by the rules by color, in one pass
+        with profiling.span("color index"):
+            color_index = ColorIndex(
+                self.analysis.records,
+                {rule[0]: self.object_types[rule[0]] for rule in rules.values()},
+            )
+
+        # assign each element to at most one rule for elements and one rule for
+        # groups, see `matching.CompiledRules`
+        with profiling.span("color filter"):
+            assigned = color_index.assign(CompiledRules(rules))
+            matches = [assigned[label] for label in rules]
+        profiling.count("colors matched", sum(len(m) for m in matches))
+
+        # the progress is measured in matched elements: each element of a rule for
+        # elements, and all of them at once for a rule for groups
+        done, total = 0, sum(len(m) for m in matches)
+
+        # inserting annotations
+        for (label, (obj, color, isgroup, _, _)), obj_elements_color in zip(
+            rules.items(), matches
+        ):
+            self._report_progress(done, total, label)
+            writer.begin_label(label, color, obj)
+            if not isgroup:
+                # the time of the elements and groups includes writing them
+                with profiling.span("elements"):
+                    annotations = self.element_annotations(obj_elements_color)
+                    for i, (id, annotation) in enumerate(annotations, 1):
+                        writer.add(id, annotation)
+                        if i % PROGRESS_EVERY == 0:
+                            self._report_progress(done + i, total, label)
+            writer.begin_groups()
+            if isgroup:
+                with profiling.span("groups"):
+                    for id, annotation in self.group_annotations(
+                        all_groups, obj_elements_color
+                    ):
+                        writer.add(id, annotation)
+            writer.end_label()
+            done += len(obj_elements_color)
+        self._report_progress(done, total, "Done")
+        with profiling.span("close"):
+            writer.close()
+
+    def annotate(self, rules):
+        """Compute the annotations of `self.svg` according to `rules` and return them
+        as a JSON-serializable dict, see `write_annotations`.
+
+        Returns:
+            dict: The annotation data, with keys "info" and "annotations".
+        """
+        writer = DictWriter()
+        self.write_annotations(rules, writer)
+        return writer.data
+
+    def save_annotations(self, rules, progress=None, cancel_event=None):
+        """
+        Export the SVG file itself into the JSON file, using `rules`. Run by the GUI
+        in a worker thread, so it does not touch the widgets: the errors, including
+        `ExportCancelled`, are raised to the caller.
+
+        The annotations are written to a temporary file and copied to the standard
+        output only when complete, so that a cancelled or failed export does not
+        leave a partial JSON file.
+
+        Args:
+            rules (dict): See `write_annotations`.
+            progress (callable): See `self.progress`.
+            cancel_event (threading.Event): See `self.cancel_event`.
+        """
+        self.progress = progress
+        if cancel_event is not None:
+            self.cancel_event = cancel_event
+        with TemporaryFile("w+", encoding="utf-8") as spool:
+            self.write_annotations(rules, AnnotationWriter(spool))
+            spool.write("\n")
+            spool.seek(0)
+            shutil.copyfileobj(spool, sys.stdout)
+        sys.stdout.flush()
@@ -0,0 +1,614 @@
+"""
+A module for estimating the bounding boxes of texts without running Inkscape.
+
+It contains a minimal pure-Python reader of TrueType/OpenType fonts (only the tables
+needed for horizontal metrics and glyph extents), a database of the fonts installed
+on the system, and a simple text layout that places the glyphs of each text element
+according to its x/y/dx/dy attributes, font and text-anchor.
+"""
+
+import bisect
+import hashlib
+import json
+import logging
+import os
+import platform
+import re
+import struct
+from pathlib import Path
+
+import inkex
+from inkex.transforms import BoundingBox
+
+from . import cache
+from .bbox import composed_transform
+
+FONT_SUFFIXES = {".ttf", ".otf", ".ttc", ".otc"}
+
+GENERIC_FAMILIES = {
+    "sans-serif": [
+        "dejavu sans",
+        "liberation sans",
+        "arial",
+        "helvetica",
+        "noto sans",
+        "freesans",
+    ],
+    "serif": [
+        "dejavu serif",
+        "liberation serif",
+        "times new roman",
+        "times",
+        "noto serif",
+        "freeserif",
+    ],
+    "monospace": [
+        "dejavu sans mono",
+        "liberation mono",
+        "courier new",
+        "courier",
+        "noto mono",
+        "freemono",
+    ],
+}
+
+# CSS absolute font-size keywords, in px
+FONT_SIZE_KEYWORDS = {
+    "xx-small": 9,
+    "x-small": 10,
+    "small": 13,
+    "medium": 16,
+    "large": 18,
+    "x-large": 24,
+    "xx-large": 32,
+}
+
+FONT_WEIGHT_KEYWORDS = {"normal": 400, "bold": 700, "lighter": 300, "bolder": 700}
+
+# the properties that are needed for the layout; all of them are inherited
+TEXT_PROPERTIES = (
+    "font-family",
+    "font-size",
+    "font-weight",
+    "font-style",
+    "text-anchor",
+    "letter-spacing",
+    "word-spacing",
+)
+
+
+def _font_dirs():
+    """Returns the directories where fonts are usually installed on this OS"""
+    home = Path.home()
+    if platform.system() == "Windows":
+        windir = Path(os.environ.get("WINDIR", "C:/Windows"))
+        local = Path(os.environ.get("LOCALAPPDATA", home / "AppData" / "Local"))
+        return [windir / "Fonts", local / "Microsoft" / "Windows" / "Fonts"]
+    elif platform.system() == "Darwin":
+        return [
+            Path("/System/Library/Fonts"),
+            Path("/Library/Fonts"),
+            home / "Library" / "Fonts",
+        ]
+    else:
+        return [
+            Path("/usr/share/fonts"),
+            Path("/usr/local/share/fonts"),
+            home / ".fonts",
+            home / ".local" / "share" / "fonts",
+        ]
+
+
+def _read_table_directory(f, offset):
+    """Reads the table directory of the font starting at `offset` of the open file
+    `f` and returns a dict `{tag: (offset, length)}`"""
+    f.seek(offset + 4)
+    (num_tables,) = struct.unpack(">H", f.read(2))
+    f.seek(offset + 12)
+    directory = f.read(16 * num_tables)
+    tables = {}
+    for i in range(num_tables):
+        tag, _, table_offset, length = struct.unpack_from(">4sIII", directory, 16 * i)
+        tables[tag.decode("latin-1")] = (table_offset, length)
+    return tables
+
+
+def _font_offsets(f):
+    """Returns the offsets of the fonts in the open file `f`, which may be a font
+    collection"""
+    f.seek(0)
+    header = f.read(12)
+    if header[:4] == b"ttcf":
+        (num_fonts,) = struct.unpack_from(">I", header, 8)
+        return list(struct.unpack(f">{num_fonts}I", f.read(4 * num_fonts)))
+    return [0]
+
+
+def _parse_names(data):
+    """Parses the `name` table and returns a dict `{name id: string}`, preferring the
+    English Windows names"""
+    _, count, string_offset = struct.unpack_from(">HHH", data, 0)
+    names = {}
+    priorities = {}
+    for i in range(count):
+        platform_id, encoding_id, language_id, name_id, length, offset = (
+            struct.unpack_from(">HHHHHH", data, 6 + 12 * i)
+        )
+        if name_id not in (1, 2, 16, 17):
+            continue
+        raw = data[string_offset + offset : string_offset + offset + length]
+        if platform_id == 3 or platform_id == 0:
+            priority = 2 if language_id == 0x409 or platform_id == 0 else 1
+            string = raw.decode("utf-16-be", errors="replace")
+        elif platform_id == 1 and encoding_id == 0:
+            priority = 0
+            string = raw.decode("mac-roman", errors="replace")
+        else:
+            continue
+        if priority >= priorities.get(name_id, -1):
+            names[name_id] = string
+            priorities[name_id] = priority
+    return names
+
+
+def read_font_descriptions(path):
+    """
+    Reads the family, weight and style of each font in the file at `path`, without
+    reading the whole file.
+
+    Returns:
+        list: a list of `[family (lowercase), weight, italic, path, index]`
+    """
+    out = []
+    with open(path, "rb") as f:
+        for index, offset in enumerate(_font_offsets(f)):
+            tables = _read_table_directory(f, offset)
+            if "name" not in tables:
+                continue
+            f.seek(tables["name"][0])
+            names = _parse_names(f.read(tables["name"][1]))
+            family = names.get(16, names.get(1))
+            if family is None:
+                continue
+            subfamily = names.get(17, names.get(2, "")).lower()
+            weight = 700 if "bold" in subfamily else 400
+            italic = "italic" in subfamily or "oblique" in subfamily
+            if "OS/2" in tables:
+                f.seek(tables["OS/2"][0])
+                os2 = f.read(64)
+                (weight,) = struct.unpack_from(">H", os2, 4)
+                (selection,) = struct.unpack_from(">H", os2, 62)
+                italic = italic or bool(selection & 1)
+            out.append([family.lower(), weight, italic, str(path), index])
+    return out
+
+
+class FontFile:
+    """
+    The horizontal metrics and glyph extents of a font in a TrueType/OpenType file.
+    All the values are in font units, see `units_per_em`.
+
+    Args:
+        path (str or Path): The font file.
+        index (int): The index of the font, if the file is a collection.
+    """
+
+    def __init__(self, path, index=0):
+        self.path = str(path)
+        with open(path, "rb") as f:
+            self._tables = _read_table_directory(f, _font_offsets(f)[index])
+            f.seek(0)
+            self._data = f.read()
+        data = self._data
+
+        head = self._tables["head"][0]
+        (self.units_per_em,) = struct.unpack_from(">H", data, head + 18)
+        (self._loca_format,) = struct.unpack_from(">h", data, head + 50)
+        hhea = self._tables["hhea"][0]
+        self.ascender, self.descender = struct.unpack_from(">hh", data, hhea + 4)
+        (self._num_hmetrics,) = struct.unpack_from(">H", data, hhea + 34)
+        self._has_outlines = "glyf" in self._tables and "loca" in self._tables
+        self._segments = self._parse_cmap()
+        self._glyphs = {}
+
+    def _parse_cmap(self):
+        """Returns the best unicode subtable of `cmap` as sorted lists of segments
+        `(starts, ends, mapper)` where `mapper(char code, segment index)` returns the
+        glyph index"""
+        data = self._data
+        cmap = self._tables["cmap"][0]
+        (num_subtables,) = struct.unpack_from(">H", data, cmap + 2)
+        subtables = {}
+        for i in range(num_subtables):
+            platform_id, encoding_id, offset = struct.unpack_from(
+                ">HHI", data, cmap + 4 + 8 * i
+            )
+            (fmt,) = struct.unpack_from(">H", data, cmap + offset)
+            if platform_id == 0 or (platform_id == 3 and encoding_id in (1, 10)):
+                subtables.setdefault(fmt, cmap + offset)
+
+        if 12 in subtables:
+            offset = subtables[12]
+            (num_groups,) = struct.unpack_from(">I", data, offset + 12)
+            groups = [
+                struct.unpack_from(">III", data, offset + 16 + 12 * i)
+                for i in range(num_groups)
+            ]
+            starts = [g[0] for g in groups]
+            ends = [g[1] for g in groups]
+
+            def mapper(code, i):
+                return groups[i][2] + code - starts[i]
+
+            return starts, ends, mapper
+
+        if 4 in subtables:
+            offset = subtables[4]
+            (seg_count_x2,) = struct.unpack_from(">H", data, offset + 6)
+            seg_count = seg_count_x2 // 2
+            ends = list(struct.unpack_from(f">{seg_count}H", data, offset + 14))
+            starts_offset = offset + 16 + seg_count_x2
+            starts = list(struct.unpack_from(f">{seg_count}H", data, starts_offset))
+            deltas = struct.unpack_from(
+                f">{seg_count}h", data, starts_offset + seg_count_x2
+            )
+            range_offsets_pos = starts_offset + 2 * seg_count_x2
+            range_offsets = struct.unpack_from(f">{seg_count}H", data, range_offsets_pos)
+
+            def mapper(code, i):
+                if range_offsets[i] == 0:
+                    return (code + deltas[i]) & 0xFFFF
+                address = (
+                    range_offsets_pos
+                    + 2 * i
+                    + range_offsets[i]
+                    + 2 * (code - starts[i])
+                )
+                (glyph,) = struct.unpack_from(">H", data, address)
+                return (glyph + deltas[i]) & 0xFFFF if glyph != 0 else 0
+
+            return starts, ends, mapper
+
+        return [], [], None
+
+    def glyph_index(self, char):
+        """Returns the index of the glyph of `char`, 0 (the missing glyph) if the
+        font does not have it"""
+        starts, ends, mapper = self._segments
+        code = ord(char)
+        i = bisect.bisect_left(ends, code)
+        if i == len(ends) or starts[i] > code:
+            return 0
+        return mapper(code, i)
+
+    def glyph_metrics(self, char):
+        """
+        Returns the metrics of the glyph of `char` as a tuple `(advance, extents)`,
+        where `extents` is `(x_min, y_min, x_max, y_max)` or None for glyphs without
+        ink (e.g. spaces). If the font has no TrueType outlines, the extents are
+        approximated with the advance and the ascender/descender.
+        """
+        if char in self._glyphs:
+            return self._glyphs[char]
+        data = self._data
+        glyph = self.glyph_index(char)
+        hmtx = self._tables["hmtx"][0]
+        (advance,) = struct.unpack_from(
+            ">H", data, hmtx + 4 * min(glyph, self._num_hmetrics - 1)
+        )
+        if self._has_outlines:
+            loca = self._tables["loca"][0]
+            if self._loca_format == 0:
+                start, end = struct.unpack_from(">HH", data, loca + 2 * glyph)
+                start, end = start * 2, end * 2
+            else:
+                start, end = struct.unpack_from(">II", data, loca + 4 * glyph)
+            if end > start:
+                extents = struct.unpack_from(
+                    ">hhhh", data, self._tables["glyf"][0] + start + 2
+                )
+            else:
+                extents = None
+        elif char.isspace():
+            extents = None
+        else:
+            extents = (0, self.descender, advance, self.ascender)
+        self._glyphs[char] = advance, extents
+        return advance, extents
+
+
+class FallbackFont:
+    """Approximated metrics used when no font file can be found"""
+
+    units_per_em = 1000
+    ascender = 800
+    descender = -200
+    path = None
+
+    def glyph_metrics(self, char):
+        if char.isspace():
+            return 250, None
+        return 550, (0, 0, 550, 700)
+
+
+class FontDatabase:
+    """
+    The fonts installed on the system, indexed by family. The index is cached on
+    disk and rebuilt only when the font files change.
+
+    Args:
+        directories (list): The directories to scan, defaults to the usual font
+            directories of the OS.
+    """
+
+    def __init__(self, directories=None):
+        if directories is None:
+            directories = _font_dirs()
+        files = sorted(
+            (str(p), p.stat().st_mtime, p.stat().st_size)
+            for directory in directories
+            if Path(directory).is_dir()
+            for p in Path(directory).rglob("*")
+            if p.suffix.lower() in FONT_SUFFIXES
+        )
+        key = hashlib.sha256(json.dumps(files).encode()).hexdigest()
+        font_cache = cache.get_cache("fonts", max_bytes=8 * 2**20)
+        cached = font_cache.get(key)
+        if cached is not None:
+            descriptions = json.loads(cached)
+        else:
+            descriptions = []
+            for path, _, _ in files:
+                try:
+                    descriptions += read_font_descriptions(path)
+                except (OSError, struct.error, KeyError) as e:
+                    logging.warning(f"Cannot read font {path}: {e}")
+            font_cache.set(key, json.dumps(descriptions))
+
+        self.families = {}
+        for family, weight, italic, path, index in descriptions:
+            self.families.setdefault(family, []).append((weight, italic, path, index))
+        self._fonts = {}
+
+    def match(self, families, weight=400, italic=False):
+        """
+        Returns the font that best matches a CSS font-family list, weight and style.
+        Generic families and, at last, "sans-serif" are resolved to common fonts; if
+        none is installed, a `FallbackFont` is returned.
+        """
+        candidates = []
+        for family in list(families) + ["sans-serif"]:
+            candidates += GENERIC_FAMILIES.get(family, [family])
+        for family in candidates:
+            faces = self.families.get(family)
+            if faces:
+                _, _, path, index = min(
+                    faces,
+                    key=lambda face: (face[1] != italic, abs(face[0] - weight)),
+                )
+                if (path, index) not in self._fonts:
+                    try:
+                        self._fonts[(path, index)] = FontFile(path, index)
+                    except (OSError, struct.error, KeyError) as e:
+                        logging.warning(f"Cannot read font {path}: {e}")
+                        self._fonts[(path, index)] = FallbackFont()
+                return self._fonts[(path, index)]
+        return FallbackFont()
+
+
+_database = None
+
+
+def get_font_database():
+    """Returns the `FontDatabase` of the system, building it only once per
+    process"""
+    global _database
+    if _database is None:
+        _database = FontDatabase()
+    return _database
+
+
+def _first_length(value, element):
+    """Returns the first number of an x/y/dx/dy attribute, in user units"""
+    if value is None:
+        return None
+    value = value.replace(",", " ").split()
+    if len(value) == 0:
+        return None
+    return element.to_dimensionless(value[0])
+
+
+def _font_size(value, parent_size, element):
+    value = value.strip()
+    if value in FONT_SIZE_KEYWORDS:
+        return FONT_SIZE_KEYWORDS[value]
+    elif value.endswith("%"):
+        return parent_size * float(value[:-1]) / 100
+    elif value.endswith("em"):
+        return parent_size * float(value[:-2])
+    try:
+        return element.to_dimensionless(value)
+    except ValueError:
+        return parent_size
+
+
+def _inherited_font_size(node):
+    """Returns the font size in user units that `node` inherits from its ancestors"""
+    size = FONT_SIZE_KEYWORDS["medium"]
+    for ancestor in reversed(list(node.ancestors())):
+        style = (
+            ancestor.cascaded_style()
+            if hasattr(ancestor, "cascaded_style")
+            else ancestor.style
+        )
+        value = style.get("font-size")
+        if value is not None and value != "inherit":
+            size = _font_size(str(value), size, ancestor)
+    return size
+
+
+def _font_weight(value):
+    value = value.strip()
+    if value in FONT_WEIGHT_KEYWORDS:
+        return FONT_WEIGHT_KEYWORDS[value]
+    try:
+        return int(value)
+    except ValueError:
+        return 400
+
+
+def _spacing(value, element):
+    if value is None or value.strip() in ("normal", "inherit", ""):
+        return 0
+    try:
+        return element.to_dimensionless(value)
+    except ValueError:
+        return 0
+
+
+class _TextLayout:
+    """Places the glyphs of a text element and accumulates their ink boxes"""
+
+    def __init__(self, database):
+        self.database = database
+        self.x = 0
+        self.y = 0
+        self.boxes = []
+        # the boxes of the current chunk, which may be shifted by text-anchor
+        self._chunk = []
+        self._chunk_start = 0
+        self._anchor = "start"
+
+    def new_chunk(self, anchor):
+        self.end_chunk()
+        self._chunk_start = self.x
+        self._anchor = anchor
+
+    def end_chunk(self):
+        width = self.x - self._chunk_start
+        shift = {"middle": -width / 2, "end": -width}.get(self._anchor, 0)
+        for left, top, right, bottom in self._chunk:
+            self.boxes.append((left + shift, top, right + shift, bottom))
+        self._chunk = []
+
+    def add_string(self, string, style, element):
+        if len(string) == 0:
+            return
+        families = [
+            f.strip().strip("'\"").lower()
+            for f in style.get("font-family", "sans-serif").split(",")
+        ]
+        font = self.database.match(
+            families,
+            _font_weight(style.get("font-weight", "normal")),
+            style.get("font-style", "normal") in ("italic", "oblique"),
+        )
+        scale = style["font-size"] / font.units_per_em
+        letter_spacing = _spacing(style.get("letter-spacing"), element)
+        word_spacing = _spacing(style.get("word-spacing"), element)
+        for char in string:
+            advance, extents = font.glyph_metrics(char)
+            if extents is not None:
+                x_min, y_min, x_max, y_max = extents
+                self._chunk.append(
+                    (
+                        self.x + x_min * scale,
+                        self.y - y_max * scale,
+                        self.x + x_max * scale,
+                        self.y - y_min * scale,
+                    )
+                )
+            self.x += advance * scale + letter_spacing
+            if char == " ":
+                self.x += word_spacing
+
+    def layout(self, element, parent_style, preserve_space=False):
+        style = dict(parent_style)
+        # the specified style also has the properties inherited from the groups that
+        # contain the text
+        specified = (
+            element.specified_style()
+            if hasattr(element, "specified_style")
+            else element.style
+        )
+        for name in TEXT_PROPERTIES:
+            value = specified.get(name)
+            if value is not None and value != "inherit":
+                style[name] = value
+        # an inherited font size is copied as it is, and a relative one must not be
+        # applied again to the size that the parent has already computed
+        own_size = (
+            element.cascaded_style()
+            if hasattr(element, "cascaded_style")
+            else element.style
+        ).get("font-size")
+        if own_size is None or own_size == "inherit":
+            style["font-size"] = parent_style["font-size"]
+        else:
+            style["font-size"] = _font_size(
+                str(own_size), parent_style["font-size"], element
+            )
+        space = element.get("{http://www.w3.org/XML/1998/namespace}space")
+        if space is not None:
+            preserve_space = space == "preserve"
+
+        x = _first_length(element.get("x"), element)
+        y = _first_length(element.get("y"), element)
+        if x is not None or y is not None:
+            self.new_chunk(style.get("text-anchor", "start"))
+            self.x = self.x if x is None else x
+            self.y = self.y if y is None else y
+            self._chunk_start = self.x
+        self.x += _first_length(element.get("dx"), element) or 0
+        self.y += _first_length(element.get("dy"), element) or 0
+
+        self.add_string(_normalize_space(element.text, preserve_space), style, element)
+        for child in element:
+            if isinstance(child, inkex.Tspan):
+                self.layout(child, style, preserve_space)
+            self.add_string(_normalize_space(child.tail, preserve_space), style, element)
+
+
+def _normalize_space(string, preserve_space):
+    if string is None:
+        return ""
+    if preserve_space:
+        return string.replace("\n", " ").replace("\t", " ")
+    return re.sub(r"\s+", " ", string)
+
+
+def estimate_text_bounding_box(node, database=None):
+    """
+    Estimates the bounding box of the glyphs of a text element from the metrics of
+    the fonts installed on the system, in the same coordinates as
+    `node.bounding_box()` with all the transforms of its ancestors applied. Returns
+    None if the text has no visible glyph.
+    """
+    if database is None:
+        database = get_font_database()
+    text_layout = _TextLayout(database)
+    text_layout.layout(node, {"font-size": _inherited_font_size(node)})
+    text_layout.end_chunk()
+    if len(text_layout.boxes) == 0:
+        return None
+
+    transform = composed_transform(node)
+    bbox = None
+    for left, top, right, bottom in text_layout.boxes:
+        for point in ((left, top), (right, top), (left, bottom), (right, bottom)):
+            x, y = transform.apply_to_point(point)
+            bbox += BoundingBox((x, x), (y, y))
+    return bbox
+
+
+def estimate_text_bounding_boxes(svg):
+    """Returns a dict with keys the text elements ids and with values the
+    `BoundingBox` estimated by `estimate_text_bounding_box`, with the same format as
+    `export.get_text_element_bounding_box`"""
+    database = get_font_database()
+    outmap = {}
+    for node in svg.descendants().filter(inkex.TextElement):
+        bbox = estimate_text_bounding_box(node, database)
+        if bbox is not None:
+            outmap[node.get_id()] = bbox
+    return outmap
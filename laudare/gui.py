@@ -1,13 +1,17 @@
 import json
+import re
+import sys
 import threading
 import time
+import traceback
 
 import gi
 
 gi.require_version("Gtk", "3.0")
 gi.require_version("Gdk", "3.0")
 from . import utils
-from gi.repository import Gdk, Gtk
+from .paths import get_cache_dir
+from gi.repository import Gdk, GLib, Gtk
 
 
 def _colors_to_gdk(colors):
@@ -74,6 +78,19 @@ def _json_file_chooser(title, action, *, window=None, multiple_files=False):
 
 
 class MainGui:
+    """
+    The window for defining the rules, with a button running `action_func`.
+
+    Args:
+        action_func (callable): Called in a worker thread as `action_func(rules,
+            progress=..., cancel_event=...)`, with the rules of `get_rule_dict`; it
+            must call `progress(done, total, message)` from time to time and stop,
+            raising an exception, when `cancel_event` is set. If it returns without
+            errors, the window is closed.
+        action_label (str): The label of the button.
+        combovalues (list): The shapes that can be chosen in the rules.
+    """
+
     def __init__(self, action_func, action_label, combovalues):
         self.rule_widgets = {}
         self.action_func = action_func
@@ -126,23 +143,85 @@ class MainGui:
         self.window.connect("destroy", self.stop)
 
     def _run_action_func(self, button):
-        # Add a progress bar with unknown duration
-        spinner = Gtk.Spinner()
+        """Runs `action_func` in a worker thread, showing its progress. The rules are
+        read here, since the widgets can only be used by the thread of the GTK main
+        loop; the worker reports to this thread through `GLib.idle_add`"""
+        try:
+            rules = self.get_rule_dict()
+        except Exception as e:
+            show_exception_dialog(e)
+            return
         button.set_label("Working...")
-        button.spinner = spinner
-        self.vbox.pack_start(spinner, True, True, 5)
+        button.set_sensitive(False)
+        self._action_button = button
+
+        self._progress_box = Gtk.HBox()
+        self._progress_bar = Gtk.ProgressBar(show_text=True)
+        self._progress_bar.set_text("Starting...")
+        self._progress_box.pack_start(self._progress_bar, True, True, 0)
+        self._cancel_button = Gtk.Button(label="Cancel")
+        self._cancel_button.connect("clicked", self._cancel_action_func)
+        self._progress_box.pack_start(self._cancel_button, False, False, 0)
+        self.vbox.pack_start(self._progress_box, True, True, 5)
         self.vbox.show_all()
-        spinner.start()
+
+        self._cancel_event = threading.Event()
+        self._action_start = time.perf_counter()
         thread = threading.Thread(
-            target=self.action_func,
-            kwargs=dict(callback=self._stop_action_func, args=(button,)),
+            target=self._action_worker, args=(rules,), daemon=True
         )
         thread.start()
 
-    def _stop_action_func(self, button):
-        button.set_label(self.action_label)
-        button.spinner.stop()
+    def _action_worker(self, rules):
+        """Body of the worker thread: never touches the widgets"""
+        error = None
+        try:
+            self.action_func(
+                rules,
+                progress=self._report_progress,
+                cancel_event=self._cancel_event,
+            )
+        except Exception as e:
+            if not self._cancel_event.is_set():
+                print(traceback.format_exc(), file=sys.stderr)
+            error = e
+        GLib.idle_add(self._stop_action_func, error)
+
+    def _report_progress(self, done, total, message):
+        """Called by the worker thread, forwards the progress to the main loop"""
+        GLib.idle_add(self._show_progress, done, total, message)
+
+    def _show_progress(self, done, total, message):
+        if self._cancel_event.is_set():
+            return False
+        fraction = done / total if total > 0 else 0
+        text = f"{message}: {done}/{total}"
+        if fraction > 0:
+            elapsed = time.perf_counter() - self._action_start
+            text += f", about {elapsed * (1 - fraction) / fraction:.0f}s left"
+        self._progress_bar.set_fraction(fraction)
+        self._progress_bar.set_text(text)
+        # run once
+        return False
+
+    def _cancel_action_func(self, button):
+        self._cancel_event.set()
+        button.set_sensitive(False)
+        self._progress_bar.set_text("Cancelling...")
+
+    def _stop_action_func(self, error):
+        """Called in the main loop when the worker thread ends: closes the window if
+        the action succeeded, otherwise shows the error, if it was not cancelled,
+        and lets the user try again"""
+        self.vbox.remove(self._progress_box)
+        self._action_button.set_label(self.action_label)
+        self._action_button.set_sensitive(True)
         self.window.show_all()
+        if error is None:
+            self.stop()
+        elif not self._cancel_event.is_set():
+            show_exception_dialog(error)
+        return False
 
     def _add_rule_widgets(self, button):
         """Adds widgets for defining a new rule"""
@@ -179,7 +258,32 @@ class MainGui:
         checkbox = Gtk.CheckButton(label="Groups Label")
         hbox.pack_start(checkbox, True, True, 0)
 
-        self.rule_widgets[id] = (label_entry, type_combo, color_button, checkbox)
+        # Create a dropdown menu for the colors that must match (see
+        # `utils.MATCH_MODES`) and a spin button for the priority of the rule
+        match_combo = Gtk.ComboBoxText()
+        for v in utils.MATCH_MODES:
+            match_combo.append_text(v)
+        match_combo.set_active(0)
+        match_combo.set_tooltip_text(
+            "Colors that must match: fill or stroke, fill, stroke, or both"
+        )
+        hbox.pack_start(match_combo, True, True, 0)
+        priority_spin = Gtk.SpinButton.new_with_range(-100, 100, 1)
+        priority_spin.set_value(0)
+        priority_spin.set_tooltip_text(
+            "Priority: a shape matched by several rules gets the label with the "
+            "highest priority"
+        )
+        hbox.pack_start(priority_spin, True, True, 0)
+
+        self.rule_widgets[id] = (
+            label_entry,
+            type_combo,
+            color_button,
+            checkbox,
+            match_combo,
+            priority_spin,
+        )
         self.vbox.show_all()
 
     def _remove_rule(self, button, hbox, id):
@@ -209,6 +313,10 @@ class MainGui:
             color.parse(values[1])  # the color
             widgets[2].set_rgba(color)
             widgets[3].set_active(values[2])  # if groups-only
+            # the colors that must match and the priority, missing in older rules
+            match = values[3] if len(values) > 3 else "any"
+            widgets[4].set_active(utils.MATCH_MODES.index(match))
+            widgets[5].set_value(values[4] if len(values) > 4 else 0)
 
     def get_rule_dict(self):
         out = {}
@@ -218,11 +326,15 @@ class MainGui:
             combotext,
             colorbutton,
             checkbox,
+            matchcombo,
+            priorityspin,
         ) in self.rule_widgets.values():
             out[entry.get_buffer().get_text()] = [
                 combotext.get_active_text(),
                 utils.color_string_to_rgb(colorbutton.get_rgba().to_string()),
                 checkbox.get_active(),
+                matchcombo.get_active_text(),
+                priorityspin.get_value_as_int(),
             ]
         return out
 
@@ -256,7 +368,7 @@ class MainGui:
         """Load the main window and the annotation from the cache"""
         try:
             self._load_gui()
-            fpath = utils.get_cache_dir() / "rules.json"
+            fpath = get_cache_dir() / "rules.json"
             if fpath.exists():
                 with open(fpath, "r") as f:
                     rules = json.load(f)
@@ -273,7 +385,7 @@ class MainGui:
         try:
             # Save the config to a file in the cache directory
             rules = self.get_rule_dict()
-            with open(utils.get_cache_dir() / "rules.json", "w") as f:
+            with open(get_cache_dir() / "rules.json", "w") as f:
                 json.dump(rules, f)
 
             # Close the main window
@@ -284,6 +396,72 @@ class MainGui:
             show_exception_dialog(e)
 
 
+class CountsDialog(Gtk.Dialog):
+    """
+    A dialog showing the counts in a `Gtk.TreeView`, which only renders the visible
+    rows. The rows can be sorted by clicking on the column headers and filtered by
+    typing in the search entry.
+
+    Args:
+        parent (Gtk.Window): The parent window, or None.
+        counts (dict): A dictionary mapping strings to integers.
+    """
+
+    def __init__(self, parent, counts):
+        Gtk.Dialog.__init__(
+            self,
+            title="Counts Dialog",
+            transient_for=parent,
+            flags=0,
+        )
+        self.add_buttons(Gtk.STOCK_CLOSE, Gtk.ResponseType.CLOSE)
+
+        self.set_default_size(250, 400)
+
+        # the store is filled before being attached to the view, so that the view
+        # does not update for each row
+        pattern = re.compile(r"\s+")
+        store = Gtk.ListStore(str, int)
+        for string, count in counts.items():
+            store.append([pattern.sub("", string), count])
+
+        self.search_entry = Gtk.SearchEntry()
+        self.search_entry.connect("search-changed", self._on_search_changed)
+        self.get_content_area().pack_start(self.search_entry, False, False, 0)
+
+        self.filter = store.filter_new()
+        self.filter.set_visible_func(self._is_visible)
+        sorted_model = Gtk.TreeModelSort(model=self.filter)
+        sorted_model.set_sort_column_id(0, Gtk.SortType.ASCENDING)
+
+        tree_view = Gtk.TreeView(model=sorted_model)
+        tree_view.set_grid_lines(Gtk.TreeViewGridLines.HORIZONTAL)
+        for i, (title, xalign) in enumerate([("Key", 0), ("Count", 1)]):
+            renderer = Gtk.CellRendererText(xalign=xalign)
+            column = Gtk.TreeViewColumn(title, renderer, text=i)
+            column.set_sort_column_id(i)
+            # with fixed sizing, rows are not measured before being shown
+            column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            column.set_expand(i == 0)
+            column.set_fixed_width(60)
+            tree_view.append_column(column)
+        tree_view.set_fixed_height_mode(True)
+
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        scrolled_window.add(tree_view)
+        self.get_content_area().pack_start(scrolled_window, True, True, 0)
+
+        self.show_all()
+
+    def _is_visible(self, model, iter, data=None):
+        text = self.search_entry.get_text().lower()
+        return text == "" or text in model[iter][0].lower()
+
+    def _on_search_changed(self, entry):
+        self.filter.refilter()
+
+
 def show_exception_dialog(e: Exception):
     """
     Shows a Gtk dialog with the exception message and on close kills the main GUI.
@@ -0,0 +1,89 @@
+"""
+A module for storing the images embedded in the SVG files (base64 data URIs) as
+separate files next to the annotations, and for inlining them back when needed.
+
+Images are content-addressed: the file name is the SHA-256 of the decoded image, so
+that each distinct image is written only once, however many JSON files refer to it.
+"""
+
+import base64
+import binascii
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import tempfile
+from pathlib import Path
+
+DATA_URI = re.compile(r"data:(?P<mime>[^;,]*)(?:;[^;,]*)*?;base64,", re.IGNORECASE)
+
+# mimetypes may map e.g. image/jpeg to .jpe on some systems
+EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/tiff": ".tif"}
+
+
+def externalize_image(href, image_dir, relative_to="."):
+    """
+    If `href` is a base64 data URI, decodes it into a file named after its SHA-256 in
+    `image_dir`, unless it already exists, and returns the path of the file relative to
+    `relative_to` (with "/" as separator) and the hash. Other hrefs (e.g. links to
+    image files) are returned unchanged, with None as hash.
+
+    Returns:
+        tuple: `(href, sha256)`
+    """
+    match = DATA_URI.match(href)
+    if match is None:
+        return href, None
+    try:
+        data = base64.b64decode(href[match.end() :])
+    except binascii.Error:
+        return href, None
+    digest = hashlib.sha256(data).hexdigest()
+    mime = match.group("mime").lower() or "application/octet-stream"
+    extension = EXTENSIONS.get(mime) or mimetypes.guess_extension(mime) or ".bin"
+
+    image_dir = Path(image_dir)
+    image_dir.mkdir(parents=True, exist_ok=True)
+    image_path = image_dir / (digest + extension)
+    if not image_path.exists():
+        # write to a temporary file first, so that concurrent exports never see a
+        # partial image
+        fd, tmp_path = tempfile.mkstemp(dir=image_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, image_path)
+    return Path(os.path.relpath(image_path, relative_to)).as_posix(), digest
+
+
+def inline_image(info, base_dir="."):
+    """
+    Replaces, in the "info" dict of an annotation file, the path of an image written
+    by `externalize_image` with the original base64 data URI. `base_dir` is the
+    directory of the annotation file. The hash of the image is checked.
+    """
+    image = info["image"]
+    digest = image.get("sha256")
+    if digest is None:
+        return info
+    image_path = Path(base_dir) / image["href"]
+    data = image_path.read_bytes()
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise RuntimeError(f"Image {image_path} does not match its hash {digest}")
+    mime = next(
+        (m for m, e in EXTENSIONS.items() if e == image_path.suffix),
+        mimetypes.guess_type(image_path.name)[0] or "application/octet-stream",
+    )
+    image["href"] = f"data:{mime};base64," + base64.b64encode(data).decode("ascii")
+    del image["sha256"]
+    return info
+
+
+def load_annotations(path, inline_images=False):
+    """Loads an annotation file; if `inline_images` is True, an image stored in a
+    separate file is inlined back as a base64 data URI, see `inline_image`"""
+    with open(path, "r") as f:
+        data = json.load(f)
+    if inline_images:
+        inline_image(data["info"], Path(path).parent)
+    return data
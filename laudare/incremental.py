@@ -0,0 +1,171 @@
+"""
+A module for re-exporting a page by only recomputing the elements that changed since the
+previous export.
+
+Each node gets a fingerprint that hashes its attributes (id, style, geometry,
+transform...), its text, the fingerprints of its children, and the transform of its
+ancestors, so that the fingerprint of a group changes whenever anything inside it
+changes. The fingerprint of a text also hashes its specified style, so that a font
+set on one of its ancestors changes it as well, and the one of a clone hashes the
+cloned node. The definitions, such as the clip paths, are part of the fingerprint of
+the whole document. The fingerprints are stored in a sidecar file next to the JSON
+output; at the next export, the bounding box and text of every node whose
+fingerprint did not change are taken from the previous JSON output instead of being
+recomputed.
+"""
+
+import hashlib
+import json
+import logging
+from pathlib import Path
+
+import inkex
+from inkex.transforms import Transform
+from lxml import etree
+
+from .bbox import composed_transform, own_transform
+
+SIDECAR_SUFFIX = ".fingerprints.json"
+VERSION = 3
+
+
+def sidecar_path(json_path):
+    json_path = Path(json_path)
+    return json_path.with_name(json_path.name + SIDECAR_SUFFIX)
+
+
+def _own_content(node):
+    """The attributes and the text of a node, as bytes"""
+    attributes = sorted(node.attrib.items())
+    return json.dumps([node.tag, attributes, node.text]).encode()
+
+
+def node_fingerprints(svg):
+    """
+    Returns a dict `{id: fingerprint}` for all the nodes of `svg` that have an id,
+    computed in a single traversal of the tree.
+    """
+    fingerprints = {}
+
+    def visit(node, parent_transform):
+        transform = parent_transform
+        if isinstance(node, inkex.BaseElement):
+            transform = parent_transform @ own_transform(node)
+        digest = hashlib.sha256(_own_content(node))
+        if isinstance(node, inkex.Use) and node.href is not None:
+            # the box of a clone is the one of the cloned node
+            digest.update(etree.tostring(node.href, with_tail=False))
+        for child in node:
+            if isinstance(child.tag, str):
+                digest.update(visit(child, transform))
+            # the tail is part of the text of the parent (e.g. after a tspan)
+            digest.update(json.dumps(child.tail).encode())
+        subtree = digest.digest()
+        node_id = node.get("id")
+        if node_id is not None:
+            fingerprint = hashlib.sha256(subtree + str(parent_transform).encode())
+            if isinstance(node, inkex.TextElement):
+                fingerprint.update(str(node.specified_style()).encode())
+            fingerprints[node_id] = fingerprint.hexdigest()
+        return subtree
+
+    visit(svg, Transform())
+    return fingerprints
+
+
+def document_fingerprint(svg, *extra):
+    """Hashes what can change the annotations of all the nodes: the size of the
+    document, the style sheets, the image, the definitions (e.g. the clip paths and
+    masks that clip the bounding boxes), and any `extra` setting of the export (e.g.
+    how the bounding boxes of texts are computed)"""
+    digest = hashlib.sha256(json.dumps([str(e) for e in extra]).encode())
+    for attr in ("width", "height", "viewBox"):
+        digest.update(f"{attr}={svg.get(attr)};".encode())
+    for node in svg.descendants():
+        if isinstance(node, (inkex.StyleElement, inkex.Image)):
+            digest.update(etree.tostring(node, with_tail=False))
+            digest.update(str(composed_transform(node)).encode())
+        elif isinstance(node, (inkex.Defs, inkex.ClipPath, inkex.Mask)):
+            digest.update(etree.tostring(node, with_tail=False))
+    return digest.hexdigest()
+
+
+class IncrementalExport:
+    """
+    The state of an incremental export of one page: the previous output and
+    fingerprints, loaded with `load`, and the current fingerprints, computed with
+    `update` before the document is modified by the export.
+
+    Args:
+        previous (dict): The previous JSON output, or None.
+        fingerprints (dict): The content of the previous sidecar file, or None.
+    """
+
+    def __init__(self, previous=None, fingerprints=None):
+        self._previous_annotations = {}
+        self._previous = fingerprints or {}
+        if previous is not None:
+            for label in previous["annotations"].values():
+                self._previous_annotations.update(label["elements"])
+                self._previous_annotations.update(label["groups"])
+        self.document = None
+        self.nodes = {}
+        self.reused = 0
+        self.recomputed = 0
+
+    @classmethod
+    def load(cls, json_path):
+        """Loads the previous output `json_path` and its sidecar file, if they
+        exist"""
+        json_path = Path(json_path)
+        sidecar = sidecar_path(json_path)
+        if not json_path.exists() or not sidecar.exists():
+            return cls()
+        try:
+            with open(sidecar, "r") as f:
+                fingerprints = json.load(f)
+            with open(json_path, "r") as f:
+                previous = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Cannot load the previous export {json_path}: {e}")
+            return cls()
+        if fingerprints.get("version") != VERSION:
+            return cls()
+        return cls(previous, fingerprints)
+
+    def update(self, svg, *extra):
+        """Computes the fingerprints of `svg`; must be called before the export
+        modifies the document. `extra` are the settings of the export that change
+        the annotations."""
+        self.document = document_fingerprint(svg, *extra)
+        self.nodes = node_fingerprints(svg)
+        if self._previous.get("document") != self.document:
+            # everything must be recomputed
+            self._previous_annotations = {}
+
+    def reuse(self, node_id):
+        """Returns the previous annotation of `node_id` if the node did not change,
+        otherwise None"""
+        previous_fingerprint = self._previous.get("nodes", {}).get(node_id)
+        annotation = self._previous_annotations.get(node_id)
+        if (
+            annotation is None
+            or previous_fingerprint is None
+            or previous_fingerprint != self.nodes.get(node_id)
+        ):
+            self.recomputed += 1
+            return None
+        self.reused += 1
+        return annotation
+
+    def save(self, json_path):
+        """Writes the current fingerprints in the sidecar file of `json_path`"""
+        with open(sidecar_path(json_path), "w") as f:
+            json.dump(
+                {"version": VERSION, "document": self.document, "nodes": self.nodes},
+                f,
+            )
+        logging.info(
+            f"Incremental export of {json_path}: {self.reused} annotations reused, "
+            f"{self.recomputed} recomputed"
+        )
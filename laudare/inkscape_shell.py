@@ -0,0 +1,202 @@
+"""
+A module for keeping Inkscape processes running in shell mode (`inkscape --shell`), so
+that many queries pay the start-up time of Inkscape only once.
+"""
+
+import atexit
+import contextlib
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+
+from inkex.command import INKSCAPE_EXECUTABLE_NAME, which
+
+PROMPT = b"> "
+
+
+class InkscapeShellError(RuntimeError):
+    pass
+
+
+class InkscapeShell:
+    """
+    An Inkscape process in shell mode. Commands are written to its stdin, one line
+    of actions at a time, and its stdout is read incrementally until the next prompt.
+
+    Args:
+        timeout (float): Seconds to wait for the answer to a command before
+            considering the process stuck.
+    """
+
+    def __init__(self, timeout=120):
+        self.timeout = timeout
+        self.process = None
+        self.start()
+
+    def start(self):
+        env = dict(os.environ, SELF_CALL="true")
+        start = time.perf_counter()
+        self.process = subprocess.Popen(
+            [which(INKSCAPE_EXECUTABLE_NAME), "--shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=env,
+        )
+        # stdout is read by a thread, so that reads can time out on every OS
+        self._chunks = queue.Queue()
+        self._buffer = b""
+        threading.Thread(
+            target=self._read_stdout,
+            args=(self.process.stdout, self._chunks),
+            daemon=True,
+        ).start()
+        # wait for the banner and the first prompt
+        self._read_until_prompt()
+        logging.info(
+            f"Started Inkscape shell (pid {self.process.pid}) in "
+            f"{time.perf_counter() - start:.2f}s"
+        )
+
+    @staticmethod
+    def _read_stdout(stdout, chunks):
+        while True:
+            chunk = stdout.read1(65536)
+            chunks.put(chunk)
+            if chunk == b"":
+                return
+
+    def _read_until_prompt(self, timeout=None):
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while not self._buffer.endswith(PROMPT):
+            try:
+                chunk = self._chunks.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                raise InkscapeShellError("Inkscape shell did not answer in time")
+            if chunk == b"":
+                raise InkscapeShellError("Inkscape shell exited unexpectedly")
+            self._buffer += chunk
+        out = self._buffer[: -len(PROMPT)]
+        self._buffer = b""
+        return out.decode("utf-8", errors="replace")
+
+    def run(self, actions, timeout=None):
+        """Runs a list of actions (e.g. `["file-open:x.svg", "query-all"]`) and
+        returns what Inkscape printed on stdout"""
+        if not self.is_alive():
+            raise InkscapeShellError("Inkscape shell is not running")
+        try:
+            self.process.stdin.write((";".join(actions) + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+        except OSError as e:
+            raise InkscapeShellError(f"Cannot write to Inkscape shell: {e}")
+        return self._read_until_prompt(timeout)
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def is_healthy(self, timeout=10):
+        """Checks that the process is running and answers an empty command"""
+        try:
+            self.run([], timeout=timeout)
+            return True
+        except InkscapeShellError:
+            return False
+
+    def restart(self):
+        logging.warning("Restarting Inkscape shell")
+        self.close()
+        self.start()
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            if self.is_alive():
+                self.process.stdin.write(b"quit\n")
+                self.process.stdin.flush()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout):
+            with contextlib.suppress(OSError):
+                pipe.close()
+        self.process = None
+
+
+class InkscapeShellPool:
+    """
+    A small pool of `InkscapeShell`, started lazily. Each shell is checked before
+    being handed out and restarted if it crashed or got stuck.
+
+    Args:
+        size (int): The maximum number of Inkscape processes.
+    """
+
+    def __init__(self, size=1):
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._shells = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def shell(self):
+        """Context manager that borrows a healthy shell from the pool"""
+        started = False
+        with self._lock:
+            if self._idle.empty() and len(self._shells) < self.size:
+                shell = InkscapeShell()
+                self._shells.append(shell)
+                started = True
+        if not started:
+            shell = self._idle.get()
+        try:
+            # the shell is given back even if it cannot be restarted, so that the
+            # next borrower tries again instead of waiting forever
+            if not started and not shell.is_healthy():
+                shell.restart()
+            yield shell
+        finally:
+            self._idle.put(shell)
+
+    def close(self):
+        with self._lock:
+            for shell in self._shells:
+                shell.close()
+            self._shells = []
+            self._idle = queue.LifoQueue()
+
+
+_pool = None
+
+
+def get_pool():
+    """Returns the pool of Inkscape shells of this process"""
+    global _pool
+    if _pool is None:
+        _pool = InkscapeShellPool()
+        atexit.register(_pool.close)
+    return _pool
+
+
+def query_all(svg_file, select="select-by-element:text", retries=1):
+    """
+    Opens `svg_file` in an Inkscape shell of the pool, runs `select` and `query-all`,
+    and returns the output of the query, in the same format as `inkscape(svg_file,
+    actions=f"{select};query-all")`. If the shell crashes, it is restarted and the
+    query is retried up to `retries` times.
+    """
+    actions = [f"file-open:{svg_file}", select, "query-all", "file-close"]
+    for attempt in range(retries + 1):
+        with get_pool().shell() as shell:
+            try:
+                return shell.run(actions)
+            except InkscapeShellError as e:
+                logging.warning(f"Inkscape shell failed on {svg_file}: {e}")
+                shell.restart()
+                if attempt == retries:
+                    raise
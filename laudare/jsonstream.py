@@ -0,0 +1,136 @@
+"""
+A module for writing the annotation JSON incrementally, so that the whole document never
+needs to be held in memory. The output is identical to `json.dumps` of the equivalent
+dict.
+"""
+
+import json
+
+# strings longer than this are escaped and written in chunks
+STRING_CHUNK = 2**20
+
+
+def _write_value(stream, value):
+    """Writes `value` as `json.dumps` would, but without building the whole string:
+    dicts are written item by item and long strings chunk by chunk"""
+    if isinstance(value, dict):
+        stream.write("{")
+        for i, (key, item) in enumerate(value.items()):
+            if i > 0:
+                stream.write(", ")
+            stream.write(json.dumps(key) + ": ")
+            _write_value(stream, item)
+        stream.write("}")
+    elif isinstance(value, str) and len(value) > STRING_CHUNK:
+        # escaping is done per character, so chunks can be escaped separately
+        stream.write('"')
+        for start in range(0, len(value), STRING_CHUNK):
+            stream.write(json.dumps(value[start : start + STRING_CHUNK])[1:-1])
+        stream.write('"')
+    else:
+        stream.write(json.dumps(value))
+
+
+class AnnotationWriter:
+    """
+    Writes the annotation JSON (see the README) to a text stream while it is being
+    produced. The methods must be called in this order::
+
+        writer.write_info(info)
+        for each label:
+            writer.begin_label(label, color, shape)
+            writer.add(element_id, annotation)  # any number of times
+            writer.begin_groups()
+            writer.add(group_id, annotation)  # any number of times
+            writer.end_label()
+        writer.close()
+
+    Args:
+        stream: A text stream, e.g. `sys.stdout` or a file opened with "w".
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._labels = 0
+        self._items = 0
+
+    def write_info(self, info):
+        self.stream.write('{"info": ')
+        _write_value(self.stream, info)
+        self.stream.write(', "annotations": {')
+
+    def begin_label(self, label, color, shape):
+        if self._labels > 0:
+            self.stream.write(", ")
+        self._labels += 1
+        self.stream.write(json.dumps(label) + ": ")
+        self.stream.write(
+            json.dumps({"color": color, "shape": shape})[:-1] + ', "elements": {'
+        )
+        self._items = 0
+
+    def add(self, key, annotation):
+        if self._items > 0:
+            self.stream.write(", ")
+        self._items += 1
+        self.stream.write(json.dumps(key) + ": ")
+        _write_value(self.stream, annotation)
+
+    def begin_groups(self):
+        self.stream.write('}, "groups": {')
+        self._items = 0
+
+    def end_label(self):
+        self.stream.write("}}")
+
+    def close(self):
+        self.stream.write("}}")
+
+
+class DictWriter:
+    """Same interface as `AnnotationWriter`, but builds the annotation dict in
+    `self.data`"""
+
+    def __init__(self):
+        self.data = {}
+        self._section = None
+
+    def write_info(self, info):
+        self.data["info"] = info
+        self.data["annotations"] = {}
+
+    def begin_label(self, label, color, shape):
+        self._label = self.data["annotations"][label] = {
+            "color": color,
+            "shape": shape,
+            "elements": {},
+            "groups": {},
+        }
+        self._section = self._label["elements"]
+
+    def add(self, key, annotation):
+        self._section[key] = annotation
+
+    def begin_groups(self):
+        self._section = self._label["groups"]
+
+    def end_label(self):
+        self._section = None
+
+    def close(self):
+        pass
+
+
+def write_dict(data, writer):
+    """Writes the annotation dict `data` (the JSON format) with `writer`, e.g. an
+    `AnnotationWriter` or a `columnar.ColumnarWriter`"""
+    writer.write_info(data["info"])
+    for label, annotations in data["annotations"].items():
+        writer.begin_label(label, annotations["color"], annotations["shape"])
+        for key, annotation in annotations["elements"].items():
+            writer.add(key, annotation)
+        writer.begin_groups()
+        for key, annotation in annotations["groups"].items():
+            writer.add(key, annotation)
+        writer.end_label()
+    writer.close()
@@ -0,0 +1,187 @@
+"""A module for matching the shapes of a document against the rules."""
+
+import math
+
+from . import utils
+
+
+class ColorIndex:
+    """
+    An index of the shapes of a document by (shape type, fill color, stroke color),
+    built with a single pass over the nodes.
+
+    Colors are those resolved by `analysis.DocumentAnalysis`, so invisible nodes are
+    indexed with colors `(None, None)` and never match any rule. Each rule is then answered
+    by only comparing its color with the distinct colors of the document, so that the
+    cost of the export scales with the number of nodes and not with the number of
+    nodes times the number of rules.
+
+    Args:
+        records (iterable): The `analysis.NodeRecord` of the nodes to index, in
+            document order.
+        object_types (dict): A dict `{shape: inkex class}`; only the nodes that are
+            instances of these classes are indexed.
+    """
+
+    def __init__(self, records, object_types):
+        self.records = []
+        # (shape, fill, stroke) -> sorted list of positions in `self.records`
+        self._index = {}
+        # shape -> colors parsed into arrays, computed when first needed
+        self._arrays = {}
+        object_types = list(object_types.items())
+        for record in records:
+            shapes = [
+                shape for shape, cls in object_types if isinstance(record.node, cls)
+            ]
+            if len(shapes) == 0:
+                continue
+            position = len(self.records)
+            self.records.append(record)
+            key = (record.fill, record.stroke)
+            for shape in shapes:
+                self._index.setdefault((shape, *key), []).append(position)
+
+    def colors(self, shape):
+        """Returns the distinct `(fill, stroke)` pairs of the visible nodes of type
+        `shape`"""
+        return [
+            (fill, stroke)
+            for s, fill, stroke in self._index
+            if s == shape and (fill is not None or stroke is not None)
+        ]
+
+    def _color_arrays(self, shape):
+        """Returns the distinct colors of `shape` parsed into arrays, see
+        `utils.rgb_array`"""
+        if shape not in self._arrays:
+            colors = self.colors(shape)
+            fills = utils.rgb_array(fill for fill, _ in colors)
+            strokes = utils.rgb_array(stroke for _, stroke in colors)
+            self._arrays[shape] = colors, fills, strokes
+        return self._arrays[shape]
+
+    def assign(self, rules):
+        """
+        Assigns the nodes to the labels of `rules` (see `CompiledRules`) in a single
+        pass: each node gets at most one label among the rules for elements and at
+        most one among the rules for groups.
+
+        Returns:
+            dict: `{label: records}`, with the records in document order.
+        """
+        # position -> (key of the chosen rule, label) for elements and groups
+        chosen = {False: {}, True: {}}
+        for shape in rules.shapes():
+            colors, fills, strokes = self._color_arrays(shape)
+            for isgroup, positions in chosen.items():
+                decisions = rules.decide(shape, isgroup, fills, strokes)
+                for i, decision in enumerate(decisions):
+                    if decision is None:
+                        continue
+                    for position in self._index[(shape, *colors[i])]:
+                        if position not in positions or decision < positions[position]:
+                            positions[position] = decision
+
+        assigned = {label: [] for label in rules.labels}
+        for positions in chosen.values():
+            for position in sorted(positions):
+                label = positions[position][-1]
+                assigned[label].append(self.records[position])
+        return assigned
+
+
+class CompiledRules:
+    """
+    The rules compiled into a decision for each color of a shape, so that all the
+    rules are evaluated at once for each distinct color of the document instead of
+    being queried one by one.
+
+    A rule matches a node of its shape if the distance of its color from the colors
+    of the node, according to its `match` mode, is below `euclidean_th`:
+
+    - "any": the nearest of fill and stroke (the fill *or* the stroke match);
+    - "fill" or "stroke": only that color;
+    - "both": the farthest of fill and stroke (the fill *and* the stroke match).
+
+    Among the rules that match a node, the node goes to the one with the highest
+    priority, then to the one whose color is the nearest, then to the first one. The
+    rules for elements and those for groups are decided separately.
+
+    Args:
+        rules (dict): The rules as returned by `utils.check_rule_dict`.
+        euclidean_th (float): See `utils.match_colors`.
+    """
+
+    def __init__(self, rules, euclidean_th=150):
+        self.labels = list(rules)
+        self.euclidean_th = euclidean_th
+        # (shape, isgroup) -> (rule colors, [(order, match, priority, label)])
+        self._rules = {}
+        rule_colors = {}
+        for order, (label, (shape, color, isgroup, match, priority)) in enumerate(
+            rules.items()
+        ):
+            rule_colors.setdefault((shape, isgroup), []).append(color)
+            self._rules.setdefault((shape, isgroup), []).append(
+                (order, match, priority, label)
+            )
+        self._colors = {
+            key: utils.rgb_array(colors)[0] for key, colors in rule_colors.items()
+        }
+
+    def shapes(self):
+        """Returns the shapes used by the rules"""
+        return sorted({shape for shape, _ in self._rules})
+
+    def decide(self, shape, isgroup, fills, strokes):
+        """
+        Decides the rule of each of N colors of nodes of type `shape`.
+
+        Args:
+            fills (tuple): The fill colors and their validity, see `utils.rgb_array`.
+            strokes (tuple): Same for the stroke colors.
+
+        Returns:
+            list: For each color, None if no rule matches, otherwise the tuple
+                `(-priority, distance, order, label)` of the rule chosen, so that
+                the decisions of different shapes can be compared: lower wins.
+        """
+        n_colors = len(fills[0])
+        if (shape, isgroup) not in self._rules:
+            return [None] * n_colors
+        rule_colors = self._colors[(shape, isgroup)]
+        distances = {}
+        for name, (colors, valid) in (("fill", fills), ("stroke", strokes)):
+            d = utils.color_distances(rule_colors, colors)
+            d[:, ~valid] = math.inf
+            distances[name] = d
+        distances["any"] = distances["fill"].clip(max=distances["stroke"])
+        distances["both"] = distances["fill"].clip(min=distances["stroke"])
+
+        decisions = [None] * n_colors
+        for row, (order, match, priority, label) in enumerate(
+            self._rules[(shape, isgroup)]
+        ):
+            for i, distance in enumerate(distances[match][row].tolist()):
+                if distance < self.euclidean_th:
+                    decision = (-priority, distance, order, label)
+                    if decisions[i] is None or decision < decisions[i]:
+                        decisions[i] = decision
+        return decisions
+
+
+def group_members(nodes):
+    """
+    Returns a dict mapping each ancestor of `nodes` to the list of `nodes` it
+    contains, in the same order as `nodes`. Each node is charged to all of its
+    ancestors at once, so that the membership of all the groups is computed in time
+    proportional to the number of nodes times the depth of the tree.
+    """
+    members = {}
+    for node in nodes:
+        parent = node.getparent()
+        while parent is not None:
+            members.setdefault(parent, []).append(node)
+            parent = parent.getparent()
+    return members
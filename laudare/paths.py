@@ -0,0 +1,40 @@
+"""A module for finding the files given on the command line and the cache directory,
+with no heavy import."""
+
+import glob
+import platform
+from pathlib import Path
+
+
+def expand_paths(patterns, suffix=".svg"):
+    """
+    Expands a list of files, directories and glob patterns into a sorted list of
+    files. Directories are searched (non recursively) for files ending with `suffix`.
+    Duplicates are removed.
+    """
+    paths = set()
+    for pattern in patterns:
+        path = Path(pattern).expanduser()
+        if path.is_dir():
+            paths.update(p for p in path.iterdir() if p.suffix.lower() == suffix)
+        elif path.exists():
+            paths.add(path)
+        else:
+            # the shell may not have expanded the glob (e.g. on Windows)
+            paths.update(Path(p) for p in glob.glob(str(path), recursive=True))
+    return sorted(paths)
+
+
+def get_cache_dir():
+    """Compute the cache directory according to the OS and returns it"""
+
+    if platform.system() == "Windows":
+        cache_directory = Path.home() / "AppData" / "Local" / "cache"
+    elif platform.system() == "Darwin":
+        cache_directory = Path.home() / "Library" / "Caches"
+    else:
+        cache_directory = Path.home() / ".cache"
+    # Create the directory if it doesn't exist
+    cache_path = cache_directory / "inkscape" / "laudare_annotator_cache"
+    cache_path.mkdir(parents=True, exist_ok=True)
+    return cache_path
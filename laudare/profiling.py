@@ -0,0 +1,114 @@
+"""
+A module for measuring where the time of an export goes: named spans accumulate the
+time spent in each stage, and counters the amount of work done (nodes scanned, boxes
+computed...).
+
+Nothing is measured unless a `Profile` is active (see `start`): `span` then returns a
+shared context manager that does nothing and `count` returns immediately, so that the
+instrumentation can stay in the code.
+
+Example::
+
+    profile = profiling.start()
+    try:
+        with profiling.span("analysis"):
+            ...
+            profiling.count("nodes scanned", len(nodes))
+    finally:
+        profiling.stop()
+    logging.info(profile.report())
+"""
+
+import contextlib
+import os
+import time
+from collections import defaultdict
+
+# "off", "log" (the profile of each export is logged) or "info" (it is also added to
+# the "info" of the exported annotations)
+PROFILE_MODES = ("off", "log", "info")
+
+_NULL_SPAN = contextlib.nullcontext()
+
+_active = None
+
+
+class _Span:
+    __slots__ = ("profile", "name", "start")
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.seconds[self.name] += time.perf_counter() - self.start
+        self.profile.calls[self.name] += 1
+        return False
+
+
+class Profile:
+    """The seconds and number of calls of each span, and the value of each counter,
+    in the order in which they were first recorded"""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def to_dict(self):
+        """Returns the profile as a JSON-serializable dict"""
+        return {
+            "spans": {
+                name: {"seconds": seconds, "calls": self.calls[name]}
+                for name, seconds in self.seconds.items()
+            },
+            "counters": dict(self.counters),
+        }
+
+    def report(self):
+        """Returns the profile as a human readable table"""
+        lines = []
+        for name, seconds in self.seconds.items():
+            lines.append(f"  {name:24s} {seconds:9.4f}s  {self.calls[name]:7d} calls")
+        for name, value in self.counters.items():
+            lines.append(f"  {name:24s} {value:10d}")
+        return "\n".join(lines)
+
+
+def mode_from_environment():
+    """Returns the profile mode set by the environment variable `LAUDARE_PROFILE`
+    (one of `PROFILE_MODES`), "off" if it is not set or not valid"""
+    mode = os.environ.get("LAUDARE_PROFILE", "off")
+    return mode if mode in PROFILE_MODES else "off"
+
+
+def start(profile=None):
+    """Activates `profile`, to continue measuring into it, or a new `Profile` in
+    this process and returns it"""
+    global _active
+    _active = Profile() if profile is None else profile
+    return _active
+
+
+def stop():
+    """Deactivates the active `Profile`, if any"""
+    global _active
+    _active = None
+
+
+def span(name):
+    """Returns a context manager that adds the time spent in it to the span `name`
+    of the active profile"""
+    if _active is None:
+        return _NULL_SPAN
+    return _Span(_active, name)
+
+
+def count(name, n=1):
+    """Adds `n` to the counter `name` of the active profile"""
+    if _active is not None:
+        _active.counters[name] += n
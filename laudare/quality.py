@@ -0,0 +1,205 @@
+"""
+A module for checking exported annotations for common mistakes: overlapping duplicate
+boxes, elements matched by several rules, boxes with zero area, and groups whose
+children are missing.
+
+Overlapping boxes are found with a spatial hash: each box is registered in the cells of
+a grid that it touches, and only the boxes sharing a cell are compared, so that the
+check is close to linear in the number of elements instead of quadratic.
+"""
+
+import argparse
+import sys
+from collections import defaultdict, namedtuple
+from xml.etree import ElementTree
+
+import numpy as np
+
+from . import counting
+from .paths import expand_paths
+
+DUPLICATE = "duplicate"
+MULTIPLE_RULES = "multiple-rules"
+ZERO_AREA = "zero-area"
+MISSING_CHILDREN = "missing-children"
+
+Issue = namedtuple("Issue", ["kind", "ids", "labels", "message"])
+
+
+def _overlapping_pairs(x, y, w, h, cell_size):
+    """Returns two arrays `i < j` with the pairs of boxes that share at least a cell
+    of a grid with cells of size `cell_size`"""
+    x0 = np.floor(x / cell_size).astype(np.int64)
+    x1 = np.floor((x + w) / cell_size).astype(np.int64)
+    y0 = np.floor(y / cell_size).astype(np.int64)
+    y1 = np.floor((y + h) / cell_size).astype(np.int64)
+    columns = x1 - x0 + 1
+    counts = columns * (y1 - y0 + 1)
+    box = np.repeat(np.arange(len(x)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    column = np.repeat(x0 - x0.min(), counts) + local % np.repeat(columns, counts)
+    row = np.repeat(y0 - y0.min(), counts) + local // np.repeat(columns, counts)
+    keys = row * (int(column.max()) + 1) + column
+    order = np.argsort(keys, kind="stable")
+    keys, box = keys[order], box[order]
+
+    # each registration is paired with the following ones in the same cell
+    cell_end = np.searchsorted(keys, keys, side="right")
+    partners = cell_end - np.arange(len(keys)) - 1
+    first = np.repeat(np.arange(len(keys)), partners)
+    offset = np.arange(partners.sum()) - np.repeat(
+        np.cumsum(partners) - partners, partners
+    )
+    i, j = box[first], box[first + 1 + offset]
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    # boxes sharing several cells are paired once per cell
+    pairs = np.unique(i * len(x) + j)
+    return pairs // len(x), pairs % len(x)
+
+
+def find_duplicates(boxes, iou_threshold=0.9):
+    """
+    Finds the pairs of boxes whose intersection over union is at least
+    `iou_threshold`.
+
+    Args:
+        boxes (numpy.ndarray): An array of shape (N, 4) with `x, y, w, h`.
+
+    Returns:
+        list: Tuples `(i, j, iou)` with `i < j`.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if len(boxes) < 2:
+        return []
+    x, y, w, h = boxes.T
+    # boxes with a high IoU have similar sizes, so a cell about the size of the
+    # boxes keeps the cells small
+    sizes = np.maximum(w, h)
+    sizes = sizes[sizes > 0]
+    cell_size = float(np.median(sizes)) if len(sizes) > 0 else 1.0
+    i, j = _overlapping_pairs(x, y, w, h, cell_size)
+    overlap_w = np.minimum(x[i] + w[i], x[j] + w[j]) - np.maximum(x[i], x[j])
+    overlap_h = np.minimum(y[i] + h[i], y[j] + h[j]) - np.maximum(y[i], y[j])
+    intersection = np.clip(overlap_w, 0, None) * np.clip(overlap_h, 0, None)
+    union = w[i] * h[i] + w[j] * h[j] - intersection
+    with np.errstate(invalid="ignore", divide="ignore"):
+        iou = np.where(union > 0, intersection / union, 0)
+    found = iou >= iou_threshold
+    return list(zip(i[found].tolist(), j[found].tolist(), iou[found].tolist()))
+
+
+def check_annotations(data, iou_threshold=0.9, page_ids=None):
+    """
+    Checks the annotations `data` (the JSON format) and returns a list of `Issue`:
+
+    - `DUPLICATE`: two different elements whose boxes overlap with an intersection
+      over union of at least `iou_threshold`;
+    - `MULTIPLE_RULES`: an element annotated with more than one label, e.g. when its
+      fill matches a rule and its stroke another one;
+    - `ZERO_AREA`: an element or group whose box has no width or no height;
+    - `MISSING_CHILDREN`: a group with fewer than two children, or, if `page_ids`
+      (the ids of the nodes of the SVG page, see `svg_ids`) is given, with children
+      that are not in the page. The children of a group do not need to be annotated
+      as elements: those of the rules for groups never are.
+    """
+    issues = []
+    element_labels = defaultdict(list)
+    element_ids, element_boxes = [], []
+    for label, annotations in data["annotations"].items():
+        for section in ("elements", "groups"):
+            for key, a in annotations[section].items():
+                if section == "elements":
+                    if len(element_labels[key]) == 0:
+                        element_ids.append(key)
+                        element_boxes.append((a["x"], a["y"], a["w"], a["h"]))
+                    element_labels[key].append(label)
+                if not (a["w"] > 0 and a["h"] > 0):
+                    issues.append(
+                        Issue(
+                            ZERO_AREA,
+                            [key],
+                            [label],
+                            f"{key} has a box of size {a['w']}x{a['h']}",
+                        )
+                    )
+
+    for key, labels in element_labels.items():
+        if len(labels) > 1:
+            issues.append(
+                Issue(
+                    MULTIPLE_RULES,
+                    [key],
+                    labels,
+                    f"{key} is matched by the rules of {', '.join(labels)}",
+                )
+            )
+
+    for i, j, iou in find_duplicates(element_boxes, iou_threshold):
+        ids = [element_ids[i], element_ids[j]]
+        labels = [element_labels[key][0] for key in ids]
+        issues.append(
+            Issue(
+                DUPLICATE,
+                ids,
+                labels,
+                f"{ids[0]} and {ids[1]} overlap (intersection over union {iou:.2f})",
+            )
+        )
+
+    for label, annotations in data["annotations"].items():
+        for key, a in annotations["groups"].items():
+            if page_ids is None:
+                missing = []
+            else:
+                missing = [c for c in a["children"] if c not in page_ids]
+            if len(a["children"]) < 2:
+                message = f"group {key} has {len(a['children'])} children"
+            elif len(missing) > 0:
+                message = f"group {key} has children not in the page: {missing}"
+            else:
+                continue
+            issues.append(Issue(MISSING_CHILDREN, [key, *missing], [label], message))
+    return issues
+
+
+def svg_ids(svg_path):
+    """Returns the set of the ids of the nodes of an SVG file"""
+    return {
+        element.get("id")
+        for _, element in ElementTree.iterparse(svg_path)
+        if element.get("id") is not None
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Check the annotations of Laudare JSON files for common mistakes"
+    )
+    parser.add_argument(
+        "jsons", nargs="+", help="JSON files, directories or glob patterns"
+    )
+    parser.add_argument(
+        "--iou",
+        type=float,
+        default=0.9,
+        help="Intersection over union above which two boxes are duplicates",
+    )
+    args = parser.parse_args(argv)
+
+    paths = expand_paths(args.jsons, suffix=".json")
+    paths = [p for p in paths if not p.name.endswith(".fingerprints.json")]
+    if len(paths) == 0:
+        parser.error("No JSON file found")
+    n_issues = 0
+    for path in paths:
+        # the SVG page is looked for next to the JSON file, with the same name
+        svg_path = path.with_suffix(".svg")
+        page_ids = svg_ids(svg_path) if svg_path.exists() else None
+        issues = check_annotations(
+            counting.load_annotations_only(path), args.iou, page_ids
+        )
+        for issue in issues:
+            print(f"{path}: {issue.kind}: {issue.message}")
+        n_issues += len(issues)
+    print(f"Found {n_issues} issues in {len(paths)} files", file=sys.stderr)
+    return 1 if n_issues > 0 else 0
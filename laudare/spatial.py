@@ -0,0 +1,386 @@
+"""
+A module for indexing the bounding boxes of the annotations of many pages, so that they
+can be queried by region, label and page without scanning every JSON file.
+
+The index is a uniform grid per page: each box is registered in every cell it touches,
+and the cells are stored as a sorted array of keys (page, row, column) with the records
+of each cell, like a sparse matrix. The index is saved as a directory of NumPy arrays
+(see `columnar`) that is memory-mapped when loaded, so it is built only once.
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from . import columnar, counting
+from .paths import expand_paths
+
+VERSION = 1
+FLOAT_COLUMNS = columnar.FLOAT_COLUMNS
+# bits of the cell key used for the column and for the row; cells are shifted so that
+# slightly negative coordinates are also valid
+CELL_BITS = 20
+CELL_SHIFT = 2 ** (CELL_BITS - 1)
+ARRAYS = (
+    "file",
+    "label",
+    "group",
+    *FLOAT_COLUMNS,
+    "cell_keys",
+    "cell_offsets",
+    "cell_records",
+)
+
+
+def _iter_annotations(path):
+    """Yields `(label, is_group, id, x, y, w, h)` for each annotation of a JSON file
+    or of a `.columns` directory"""
+    path = Path(path)
+    if path.is_dir():
+        data = columnar.ColumnarAnnotations(path)
+        ids = data.strings("id")
+        floats = [getattr(data, name).tolist() for name in FLOAT_COLUMNS]
+        for row, (label, group) in enumerate(
+            zip(data.label.tolist(), data.group.tolist())
+        ):
+            name = data.labels[label]["name"]
+            yield (name, group, ids[row], *(column[row] for column in floats))
+        return
+    data = counting.load_annotations_only(path)
+    for label, annotations in data["annotations"].items():
+        for group, section in ((False, "elements"), (True, "groups")):
+            for key, a in annotations[section].items():
+                yield label, group, key, a["x"], a["y"], a["w"], a["h"]
+
+
+def _cell_range(start, size, cell_size):
+    first = np.floor(start / cell_size).astype(np.int64) + CELL_SHIFT
+    last = np.floor((start + size) / cell_size).astype(np.int64) + CELL_SHIFT
+    return (
+        np.clip(first, 0, 2**CELL_BITS - 1),
+        np.clip(last, 0, 2**CELL_BITS - 1),
+    )
+
+
+def _cell_key(file, row, column):
+    return (np.int64(file) << (2 * CELL_BITS)) | (row << CELL_BITS) | column
+
+
+class SpatialIndex:
+    """
+    A grid index over the bounding boxes of the annotations of many files. Build it
+    with `build` or load it with `load`.
+
+    Each record is an annotated element or group; its attributes are in the arrays
+    `file` (index in `files`), `label` (index in `labels`), `group`, `x`, `y`, `w`,
+    `h`, and its id is returned by `record`.
+
+    Args:
+        meta (dict): The files, labels and cell size.
+        arrays (dict): The arrays, see `ARRAYS`.
+        ids (tuple): The offsets and data of the string column of the ids.
+    """
+
+    def __init__(self, meta, arrays, ids):
+        self.meta = meta
+        self.files = meta["files"]
+        self.labels = meta["labels"]
+        self.cell_size = meta["cell_size"]
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self._ids = ids
+
+    def __len__(self):
+        return len(self.x)
+
+    @classmethod
+    def build(cls, paths, cell_size=64.0):
+        """
+        Builds the index of the annotations of `paths`, JSON files or `.columns`
+        directories (see `columnar`).
+
+        Args:
+            paths (list): The annotation files.
+            cell_size (float): The size of the cells of the grid, in px; about the
+                size of the most frequent boxes is a good choice.
+        """
+        labels = {}
+        records = {name: [] for name in ("file", "label", "group", *FLOAT_COLUMNS)}
+        ids = columnar.StringColumn()
+        for file, path in enumerate(paths):
+            for label, group, key, *box in _iter_annotations(path):
+                records["file"].append(file)
+                records["label"].append(labels.setdefault(label, len(labels)))
+                records["group"].append(group)
+                for name, value in zip(FLOAT_COLUMNS, box):
+                    records[name].append(value)
+                ids.append(key)
+
+        arrays = {
+            "file": np.array(records["file"], dtype=np.int32),
+            "label": np.array(records["label"], dtype=np.int32),
+            "group": np.array(records["group"], dtype=bool),
+        }
+        for name in FLOAT_COLUMNS:
+            arrays[name] = np.array(records[name], dtype=np.float64)
+
+        # register each record in all the cells it touches
+        x0, x1 = _cell_range(arrays["x"], arrays["w"], cell_size)
+        y0, y1 = _cell_range(arrays["y"], arrays["h"], cell_size)
+        columns = x1 - x0 + 1
+        counts = columns * (y1 - y0 + 1)
+        record = np.repeat(np.arange(len(counts)), counts)
+        starts = np.cumsum(counts) - counts
+        local = np.arange(counts.sum()) - np.repeat(starts, counts)
+        column = np.repeat(x0, counts) + local % np.repeat(columns, counts)
+        row = np.repeat(y0, counts) + local // np.repeat(columns, counts)
+        keys = _cell_key(arrays["file"][record].astype(np.int64), row, column)
+        order = np.argsort(keys, kind="stable")
+        arrays["cell_keys"], first = np.unique(keys[order], return_index=True)
+        arrays["cell_offsets"] = np.append(first, len(keys)).astype(np.int64)
+        arrays["cell_records"] = record[order].astype(np.int64)
+
+        meta = {
+            "version": VERSION,
+            "cell_size": cell_size,
+            "files": [str(path) for path in paths],
+            "labels": list(labels),
+        }
+        ids_arrays = (
+            np.frombuffer(ids.offsets, np.int64),
+            np.frombuffer(ids.data, np.uint8),
+        )
+        return cls(meta, arrays, ids_arrays)
+
+    def save(self, directory):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in ARRAYS:
+            np.save(directory / f"{name}.npy", getattr(self, name))
+        np.save(directory / "id.offsets.npy", self._ids[0])
+        np.save(directory / "id.data.npy", self._ids[1])
+        # written last: a directory without meta.json is incomplete
+        with open(directory / "meta.json", "w") as f:
+            json.dump(self.meta, f)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """Loads an index saved by `save`; the arrays are memory-mapped by default"""
+        directory = Path(directory)
+        with open(directory / "meta.json", "r") as f:
+            meta = json.load(f)
+        if meta["version"] != VERSION:
+            raise ValueError(f"Unsupported spatial index version {meta['version']}")
+
+        def load(name):
+            return np.load(directory / f"{name}.npy", mmap_mode=mmap_mode)
+
+        arrays = {name: load(name) for name in ARRAYS}
+        return cls(meta, arrays, (load("id.offsets"), load("id.data")))
+
+    def record(self, i):
+        """Returns the record `i` as a dict with keys `file`, `label`, `group`, `id`,
+        `x`, `y`, `w`, `h`"""
+        offsets, data = self._ids
+        record = {
+            "file": self.files[self.file[i]],
+            "label": self.labels[self.label[i]],
+            "group": bool(self.group[i]),
+            "id": data[offsets[i] : offsets[i + 1]].tobytes().decode("utf-8"),
+        }
+        for name in FLOAT_COLUMNS:
+            record[name] = float(getattr(self, name)[i])
+        return record
+
+    def _file_indices(self, files):
+        if files is None:
+            return range(len(self.files))
+        indices = {str(f): i for i, f in enumerate(self.files)}
+        return [indices[str(f)] for f in files]
+
+    def _cells(self, keys):
+        """Returns the records registered in the cells `keys`, with duplicates"""
+        keys = np.asarray(keys, dtype=np.int64)
+        position = np.searchsorted(self.cell_keys, keys)
+        found = position < len(self.cell_keys)
+        found[found] = self.cell_keys[position[found]] == keys[found]
+        position = position[found]
+        if len(position) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(
+            [
+                self.cell_records[self.cell_offsets[p] : self.cell_offsets[p + 1]]
+                for p in position.tolist()
+            ]
+        )
+
+    def _filter(self, records, labels, group):
+        if labels is not None:
+            indices = [i for i, label in enumerate(self.labels) if label in labels]
+            records = records[np.isin(self.label[records], indices)]
+        if group is not None:
+            records = records[self.group[records] == group]
+        return records
+
+    def query(self, region, files=None, labels=None, group=None):
+        """
+        Returns the records whose box intersects `region`, sorted.
+
+        Args:
+            region (tuple): `(x, y, w, h)`, in the same coordinates as the
+                annotations.
+            files (list): Only search these files (as given to `build`); defaults to
+                all the files.
+            labels (list): Only return records of these labels.
+            group (bool): Only return groups (True) or elements (False).
+
+        Returns:
+            numpy.ndarray: The indices of the records, see `record`.
+        """
+        x, y, w, h = region
+        x0, x1 = _cell_range(np.float64(x), np.float64(w), self.cell_size)
+        y0, y1 = _cell_range(np.float64(y), np.float64(h), self.cell_size)
+        rows, columns = np.meshgrid(
+            np.arange(y0, y1 + 1), np.arange(x0, x1 + 1), indexing="ij"
+        )
+        keys = np.concatenate(
+            [
+                _cell_key(file, rows.ravel(), columns.ravel())
+                for file in self._file_indices(files)
+            ]
+            or [np.empty(0, dtype=np.int64)]
+        )
+        records = np.unique(self._cells(np.sort(keys)))
+        records = records[
+            (self.x[records] <= x + w)
+            & (self.x[records] + self.w[records] >= x)
+            & (self.y[records] <= y + h)
+            & (self.y[records] + self.h[records] >= y)
+        ]
+        return self._filter(records, labels, group)
+
+    def _distances(self, records, px, py):
+        x, y = self.x[records], self.y[records]
+        dx = np.maximum(np.maximum(x - px, px - x - self.w[records]), 0)
+        dy = np.maximum(np.maximum(y - py, py - y - self.h[records]), 0)
+        return np.hypot(dx, dy)
+
+    def nearest(self, file, point, k=1, labels=None, group=None):
+        """
+        Returns the `k` records of `file` nearest to `point` (the distance is 0 for
+        the boxes that contain it), searching the cells in rings of increasing size
+        around the point.
+
+        Args:
+            file: The file, as given to `build`.
+            point (tuple): `(x, y)`.
+            k (int): The number of records.
+            labels (list): Only return records of these labels.
+            group (bool): Only return groups (True) or elements (False).
+
+        Returns:
+            tuple: The indices of the records, see `record`, and their distances,
+                sorted by distance.
+        """
+        file = self._file_indices([file])[0]
+        px, py = point
+        column, _ = _cell_range(np.float64(px), np.float64(0), self.cell_size)
+        row, _ = _cell_range(np.float64(py), np.float64(0), self.cell_size)
+        # the cells of the file, to know when to stop
+        lo = np.searchsorted(self.cell_keys, _cell_key(file, 0, 0))
+        hi = np.searchsorted(self.cell_keys, _cell_key(file + 1, 0, 0))
+        if lo == hi:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        file_keys = self.cell_keys[lo:hi]
+        mask = 2**CELL_BITS - 1
+        file_rows = (file_keys >> CELL_BITS) & mask
+        file_columns = file_keys & mask
+        max_ring = max(
+            abs(int(file_rows.min()) - row),
+            abs(int(file_rows.max()) - row),
+            abs(int(file_columns.min()) - column),
+            abs(int(file_columns.max()) - column),
+        )
+
+        seen = np.empty(0, dtype=np.int64)
+        distances = np.empty(0)
+        for ring in range(max_ring + 1):
+            if ring == 0:
+                rows, columns = np.array([row]), np.array([column])
+            else:
+                side = np.arange(-ring, ring + 1)
+                inner = side[1:-1]
+                rows = row + np.concatenate(
+                    [np.full(len(side), -ring), np.full(len(side), ring), inner, inner]
+                )
+                columns = column + np.concatenate(
+                    [side, side, np.full(len(inner), -ring), np.full(len(inner), ring)]
+                )
+            valid = (rows >= 0) & (columns >= 0)
+            valid &= (rows < 2**CELL_BITS) & (columns < 2**CELL_BITS)
+            keys = np.sort(_cell_key(file, rows[valid], columns[valid]))
+            records = np.unique(self._filter(self._cells(keys), labels, group))
+            records = records[~np.isin(records, seen)]
+            if len(records) > 0:
+                seen = np.concatenate([seen, records])
+                distances = np.concatenate(
+                    [distances, self._distances(records, px, py)]
+                )
+            # boxes not seen yet are at least `ring` cells away from the point
+            if len(seen) >= k and np.partition(distances, k - 1)[k - 1] <= (
+                ring * self.cell_size
+            ):
+                break
+        order = np.argsort(distances, kind="stable")[:k]
+        return seen[order], distances[order]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build or query a spatial index of the annotations of many files"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Build an index")
+    build.add_argument(
+        "annotations",
+        nargs="+",
+        help="JSON files, directories or glob patterns, or .columns directories",
+    )
+    build.add_argument("-o", "--output", required=True, help="Index directory")
+    build.add_argument(
+        "--cell-size", type=float, default=64.0, help="Size of the grid cells in px"
+    )
+    query = subparsers.add_parser(
+        "query", help="Print the records intersecting a region, as JSON lines"
+    )
+    query.add_argument("index", help="Index directory")
+    query.add_argument(
+        "--region", nargs=4, type=float, required=True, metavar=("X", "Y", "W", "H")
+    )
+    query.add_argument("--file", action="append", help="Only search this file")
+    query.add_argument("--label", action="append", help="Only return this label")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        paths = []
+        for pattern in args.annotations:
+            if Path(pattern).suffix == columnar.SUFFIX and Path(pattern).is_dir():
+                paths.append(Path(pattern))
+            else:
+                paths += expand_paths([pattern], suffix=".json")
+        paths = [p for p in paths if not p.name.endswith(".fingerprints.json")]
+        if len(paths) == 0:
+            parser.error("No annotation file found")
+        index = SpatialIndex.build(paths, cell_size=args.cell_size)
+        index.save(args.output)
+        print(
+            f"Indexed {len(index)} annotations of {len(paths)} files", file=sys.stderr
+        )
+    else:
+        index = SpatialIndex.load(args.index)
+        for i in index.query(args.region, files=args.file, labels=args.label):
+            print(json.dumps(index.record(i)))
+    return 0
@@ -1,11 +1,12 @@
+import functools
 import logging
-import platform
-from pathlib import Path
 from typing import Optional
 
 import inkex
 import numpy as np
 
+from .paths import get_cache_dir
+
 SUPPORTED_TYPES = {
     "Text": inkex.TextElement,
     "Path": inkex.PathElement,
@@ -13,8 +14,9 @@ SUPPORTED_TYPES = {
     "Rectangle": inkex.Rectangle,
 }
 
-# patch TextElement to retrieve nested tspans
-inkex.TextElement.tspans = lambda self: self.findall('.//svg:tspan')
+# which colors of a shape must match the color of a rule: fill or stroke, only the
+# fill, only the stroke, or both
+MATCH_MODES = ("any", "fill", "stroke", "both")
 
 
 def color_string_to_rgb(color):
@@ -61,12 +63,13 @@ def color_string_to_rgb(color):
 def check_rule_labels(rules):
     labels = set()
     combinations = set()
-    for label, obj, color, isgroup in rules.values():
+    for label, obj, color, isgroup, match, _ in rules.values():
         value = label.get_buffer().get_text()
         combination = (
             obj.get_active_text(),
             color.get_rgba().to_string(),
             isgroup.get_active(),
+            match.get_active_text(),
         )
         if value in labels or combination in combinations:
             raise RuntimeError(
@@ -77,30 +80,48 @@ def check_rule_labels(rules):
             combinations.add(combination)
 
 
-def get_cache_dir():
-    """Compute the cache directory according to the OS and returns it"""
-
-    if platform.system() == "Windows":
-        cache_directory = Path.home() / "AppData" / "Local" / "cache"
-    elif platform.system() == "Darwin":
-        cache_directory = Path.home() / "Library" / "Caches"
-    else:
-        cache_directory = Path.home() / ".cache"
-    # Create the directory if it doesn't exist
-    cache_path = cache_directory / "inkscape" / "laudare_annotator_cache"
-    cache_path.mkdir(parents=True, exist_ok=True)
-    return cache_path
+def check_rule_dict(rules):
+    """
+    Same as `check_rule_labels`, but for rules in the `{label: [shape, color,
+    isgroup, match, priority]}` format written by `MainGui.save_config`, where `match`
+    (one of `MATCH_MODES`, default "any") and `priority` (an integer, default 0) can
+    be omitted. Returns the rules with all the five values and with colors
+    normalized to the rgb(...) syntax.
+    """
+    combinations = set()
+    out = {}
+    for label, (obj, color, isgroup, *options) in rules.items():
+        if obj not in SUPPORTED_TYPES:
+            raise RuntimeError(f"Unsupported shape for label {label}: {obj}")
+        match = options[0] if len(options) > 0 else "any"
+        if match not in MATCH_MODES:
+            raise RuntimeError(f"Unsupported color match for label {label}: {match}")
+        priority = int(options[1]) if len(options) > 1 else 0
+        color = color_string_to_rgb(color)
+        combination = (obj, color, bool(isgroup), match)
+        if combination in combinations:
+            raise RuntimeError(
+                f"Duplicate label or combination: {label}, {combination}"
+            )
+        combinations.add(combination)
+        out[label] = [obj, color, bool(isgroup), match, priority]
+    return out
 
 
 def _parse_num(v: str):
     return float(v) if v else 0
 
 
-def node_can_be_seen(node):
+def node_can_be_seen(node, bboxes=None):
     """
     Given a node, return True if it can be seen by the user in Inkscape, False otherwise
     (e.g. an empty text or a line with stroke-wdth of 0 or completely transparent
      objects)
+
+    Args:
+        node (inkex.BaseElement): The node.
+        bboxes (bbox.BoundingBoxes): If provided, the bounding box of the node is
+            taken from here instead of being computed.
     """
     if node.style.get("display") == "hidden":
         return False
@@ -123,7 +144,7 @@ def node_can_be_seen(node):
         elif not is_stroked and not is_filled:
             return True
     elif isinstance(node, inkex.ShapeElement):
-        bbox = node.bounding_box()
+        bbox = node.bounding_box() if bboxes is None else bboxes.bbox(node)
         if is_filled and not is_stroked:
             if bbox is not None and bbox.area == 0:
                 return False
@@ -136,26 +157,62 @@ def node_can_be_seen(node):
     return True
 
 
+@functools.lru_cache(maxsize=4096)
+def _rgb_tuple(color):
+    if not color.startswith("rgb(") or not color.endswith(")"):
+        raise RuntimeError("Color must be in RGB format")
+    return tuple(int(c) for c in color[4:-1].split(","))
+
+
+def rgb_array(colors):
+    """
+    Parses rgb(...) strings into an array of shape (N, 3) and dtype uint8, so that
+    many colors can be compared at once with `color_distances`.
+
+    Args:
+        colors (iterable): The colors in rgb(...) format; `None` values are allowed.
+
+    Returns:
+        tuple: The (N, 3) array and a boolean array of shape (N,) that is False
+            where the color was `None` (the corresponding row is black).
+    """
+    colors = list(colors)
+    valid = np.array([c is not None for c in colors], dtype=bool)
+    rgb = np.array(
+        [_rgb_tuple(c) if c is not None else (0, 0, 0) for c in colors],
+        dtype=np.uint8,
+    ).reshape(-1, 3)
+    return rgb, valid
+
+
+def color_distances(colors_a, colors_b):
+    """Returns the (N, M) matrix of euclidean distances between the colors of the
+    (N, 3) array `colors_a` and of the (M, 3) array `colors_b`, computed in a single
+    broadcasted operation"""
+    diff = colors_a[:, None, :].astype(np.int32) - colors_b[None, :, :].astype(np.int32)
+    return np.sqrt((diff * diff).sum(axis=-1))
+
+
+def matching_colors(colors_a, colors_b, valid_b=None, euclidean_th=150):
+    """Returns the (N, M) boolean matrix that is True where the colors of the two
+    arrays are near in an euclidean space. Columns where `valid_b` is False never
+    match."""
+    matches = color_distances(colors_a, colors_b) < euclidean_th
+    if valid_b is not None:
+        matches &= valid_b[None, :]
+    return matches
+
+
 def match_colors(color_query, *colors, euclidean_th=150):
     """Return True if `color` is near to one of *colors in an euclidean
     space"""
 
     if color_query is None:
         raise RuntimeError("Color must be in RGB format")
-    if not color_query.startswith("rgb(") or not color_query.endswith(")"):
-        raise RuntimeError("Color must be in RGB format")
-
-    # convert color strings to RGB values
-    color_rgb = np.array([int(c) for c in color_query[4:-1].split(",")])
 
-    for color in colors:
-        if color is not None:
-            c_rgb = np.array([int(c) for c in color[4:-1].split(",")])
-            distance = np.linalg.norm(color_rgb - c_rgb)
-            if distance < euclidean_th:
-                return True
-
-    return False
+    query, _ = rgb_array([color_query])
+    candidates, valid = rgb_array(colors)
+    return bool(matching_colors(query, candidates, valid, euclidean_th).any())
 
 
 def get_node_color(node, name="fill") -> Optional[str]:
@@ -176,25 +233,74 @@ def get_node_color(node, name="fill") -> Optional[str]:
         return None
 
 
+def get_node_colors(node, bboxes=None):
+    """
+    Returns the RGB colors `(fill, stroke)` of a node, like `get_node_color`, but
+    checking the visibility of the node only once. `bboxes` is passed to
+    `node_can_be_seen`.
+    """
+    style = node.style
+    fill = style.get("fill")
+    stroke = style.get("stroke")
+    if (fill in (None, "none") and stroke in (None, "none")) or not node_can_be_seen(
+        node, bboxes
+    ):
+        return None, None
+    fill = None if fill == "none" else color_string_to_rgb(fill)
+    stroke = None if stroke == "none" else color_string_to_rgb(stroke)
+    return fill, stroke
+
+
+def reduce_palette(colors, euclidean_th=150):
+    """Returns the set of rgb(..) strings obtained by taking `colors` in order and
+    skipping those near to a color already taken (see `match_colors`)"""
+    colors = list(dict.fromkeys(colors))
+    if len(colors) == 0:
+        return set()
+
+    rgb, _ = rgb_array(colors)
+    near = matching_colors(rgb, rgb, euclidean_th=euclidean_th)
+    kept = np.zeros(len(colors), dtype=bool)
+    for i in range(len(colors)):
+        if not near[i, kept].any():
+            kept[i] = True
+    return {color for color, k in zip(colors, kept) if k}
+
+
 def get_svg_palette(svg):
     """Returns all colors from an SVG object as a set of rgb(..) strings"""
-    colors = set()
+    colors = []
     for node in svg.descendants():
-        stroke = get_node_color(node, "stroke")
-        if stroke is not None and not match_colors(stroke, *colors):
-            colors.add(stroke)
+        fill, stroke = get_node_colors(node)
+        if stroke is not None:
+            colors.append(stroke)
+        if fill is not None:
+            colors.append(fill)
+    return reduce_palette(colors)
 
-        fill = get_node_color(node, "fill")
-        if fill is not None and not match_colors(fill, *colors):
-            colors.add(fill)
 
-    return colors
+_setup_done = False
 
 
-log_file_path = get_cache_dir() / f"laudare_annotator.log"
-logging.basicConfig(
-    filename=log_file_path,
-    level=logging.DEBUG,
-    filemode="a",
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+def setup():
+    """
+    Prepares the process for running the extensions; nothing is done when the
+    modules are imported, so that importing them is fast and has no side effects.
+    Only the first call has an effect:
+
+    - logging is configured to append to `laudare_annotator.log` in the cache
+      directory (which is created);
+    - `inkex.TextElement.tspans` is patched to return the nested tspans too, so that
+      the bounding boxes computed by inkex include them.
+    """
+    global _setup_done
+    if _setup_done:
+        return
+    _setup_done = True
+    logging.basicConfig(
+        filename=get_cache_dir() / "laudare_annotator.log",
+        level=logging.DEBUG,
+        filemode="a",
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+    inkex.TextElement.tspans = lambda self: self.findall(".//svg:tspan")
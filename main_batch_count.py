@@ -0,0 +1,3 @@
+if __name__ == "__main__":
+    from laudare import batch_count
+    raise SystemExit(batch_count.main())
@@ -0,0 +1,3 @@
+if __name__ == "__main__":
+    from laudare import batch_export
+    raise SystemExit(batch_export.main())
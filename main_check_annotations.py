@@ -0,0 +1,3 @@
+if __name__ == "__main__":
+    from laudare import quality
+    raise SystemExit(quality.main())
@@ -0,0 +1,3 @@
+if __name__ == "__main__":
+    from laudare import spatial
+    raise SystemExit(spatial.main())
@@ -0,0 +1,46 @@
+import io
+
+import inkex
+
+from laudare.export import LaudareExport
+from laudare.jsonstream import DictWriter
+
+SVG = """<svg xmlns="http://www.w3.org/2000/svg"
+    xmlns:xlink="http://www.w3.org/1999/xlink" width="100" height="100">
+  <image id="image" x="0" y="0" width="100" height="100" xlink:href="scan.png"/>
+  <g id="g1" transform="translate(10,5)">
+    <ellipse id="e1" cx="20" cy="20" rx="5" ry="3" transform="scale(0.804)"
+        style="fill:#ff0000;fill-opacity:1"/>
+    <ellipse id="e2" cx="40" cy="10" rx="4" ry="4" transform="translate(1.50)"
+        style="fill:#ff0000;fill-opacity:1"/>
+    <rect id="r1" x="30" y="30" width="10" height="5" transform="rotate(-3.70)"
+        style="fill:#ff0000;fill-opacity:1"/>
+  </g>
+</svg>"""
+
+RULES = {
+    "ellipse": ["Ellipse", "#ff0000", False],
+    "rect": ["Rectangle", "#ff0000", False],
+    "group": ["Ellipse", "#ff0000", True],
+}
+
+
+def test_export_does_not_rewrite_transforms():
+    svg = inkex.load_svg(io.BytesIO(SVG.encode())).getroot()
+    before = {
+        node.get_id(): node.attrib.get("transform")
+        for node in svg.iter()
+        if isinstance(node.tag, str)
+    }
+    extension = LaudareExport()
+    extension.text_bbox_mode = "native"
+    extension.svg = svg
+    writer = DictWriter()
+    extension.write_annotations(RULES, writer)
+
+    annotations = writer.data["annotations"]
+    assert set(annotations["ellipse"]["elements"]) == {"e1", "e2"}
+    assert set(annotations["group"]["groups"]) == {"g1"}
+    # `node.get("transform")` would itself rewrite the attribute
+    for node_id, transform in before.items():
+        assert svg.getElementById(node_id).attrib.get("transform") == transform
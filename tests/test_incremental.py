@@ -0,0 +1,42 @@
+import json
+
+from laudare.batch_export import export_file
+
+SVG = """<svg xmlns="http://www.w3.org/2000/svg"
+    xmlns:xlink="http://www.w3.org/1999/xlink" width="100" height="100">
+  <defs>
+    <clipPath id="clip">
+      <rect id="clip-rect" x="{clip_x}" y="0" width="20" height="100"/>
+    </clipPath>
+  </defs>
+  <image id="image" x="0" y="0" width="100" height="100" xlink:href="scan.png"/>
+  <rect id="r1" x="0" y="10" width="50" height="10" clip-path="url(#clip)"
+      style="fill:#ff0000;fill-opacity:1"/>
+  <rect id="r2" x="60" y="10" width="10" height="10"
+      style="fill:#ff0000;fill-opacity:1"/>
+</svg>"""
+
+RULES = {"rect": ["Rectangle", "#ff0000", False]}
+
+
+def _annotations(json_path):
+    with open(json_path, "r") as f:
+        return json.load(f)["annotations"]
+
+
+def test_incremental_export_follows_clip_paths(tmp_path):
+    (tmp_path / "inc").mkdir()
+    (tmp_path / "full").mkdir()
+    svg_path = tmp_path / "page.svg"
+    svg_path.write_text(SVG.format(clip_x=0))
+    export_file(svg_path, RULES, tmp_path / "inc", "native", incremental=True)
+
+    # moving the rect of the clip path changes the box of the clipped rect
+    svg_path.write_text(SVG.format(clip_x=10))
+    incremental = export_file(
+        svg_path, RULES, tmp_path / "inc", "native", incremental=True
+    )
+    full = export_file(svg_path, RULES, tmp_path / "full", "native")
+
+    assert _annotations(incremental) == _annotations(full)
+    assert _annotations(full)["rect"]["elements"]["r1"]["x"] == 10